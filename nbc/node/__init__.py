@@ -1,7 +1,9 @@
 
+import socket
 import sys
 from six import PY3
 
+miniupnpc = None  # only bundled for MAC OS, no port mapping on other platform
 if PY3:
   if sys.platform == 'darwin':
     from .darwin3 import miniupnpc
@@ -12,11 +14,17 @@ else:
 class AddrInUseError(Exception): pass
 class StopNode(Exception): pass
 
+def set_reuse_port(sock):  # let processes share one listening port, kernel balances accepting
+  option = getattr(socket,'SO_REUSEPORT',None)
+  if option is None:
+    raise RuntimeError('SO_REUSEPORT not supported on this platform')
+  sock.setsockopt(socket.SOL_SOCKET,option,1)
+
 _upnp = None
 
 def _init_upnp():
   global _upnp
-  if _upnp: return _upnp
+  if _upnp or miniupnpc is None: return _upnp
   
   u = miniupnpc.UPnP()
   u.discoverdelay = 200
@@ -31,6 +39,7 @@ def _init_upnp():
 
 def add_portmap(port, proto, label=''):
   u = _init_upnp()
+  if u is None: return
   try:
     u.selectigd()  # select Internet Gateway Device
     extAddr = u.externalipaddress()
@@ -0,0 +1,416 @@
+import hashlib
+import heapq
+import os
+import random
+import struct
+import tempfile
+import time
+
+from ..protocol import format
+
+__all__ = ['AddressManager', 'network_group']
+
+NEW_BUCKET_COUNT = 256        # buckets of addresses heard of but never connected
+TRIED_BUCKET_COUNT = 64       # buckets of addresses we connected successfully
+BUCKET_SIZE = 64              # addresses in one bucket
+NEW_BUCKETS_PER_SOURCE = 32   # buckets one source group can fill, so a liar can not flood the table
+TRIED_BUCKETS_PER_GROUP = 8   # buckets one network group can take in tried table
+
+HORIZON_DAYS = 30             # addresses not seen for that long are dropped
+MAX_RETRIES = 3               # failed attempts of a never connected address before dropping it
+MAX_FAILURES = 10             # failed attempts since last success before dropping it
+RETRY_SECONDS = 60            # do not select an address tried recently, doubled on each failure
+MAX_RETRY_SECONDS = 3600      # longest backoff of a failing address
+SELECT_TRIES = 50             # random picks before select() gives up
+MAX_FUTURE_SECONDS = 600      # a timestamp further in the future is a lie
+MIN_TIMESTAMP = 100000000     # an older timestamp (1973) is bogus
+UNKNOWN_AGE_DAYS = 5          # age given to an address announced with a bogus timestamp
+
+_FILE_MAGIC = b'NBCA'
+_FILE_VERSION = 1
+_RECORD = struct.Struct('<16sH16sIQIIHB')  # ip port source timestamp services last_try last_success attempts tried
+
+_ip_format = format.FtIPAddress()
+_NO_SOURCE = b'\x00' * 16
+
+def network_group(ip):  # /16 of IPv4, /32 of IPv6
+  if ':' in ip:
+    return ':'.join(ip.split(':')[:2])
+  return '.'.join(ip.split('.')[:2])
+
+class _Entry(object):
+  __slots__ = ('address', 'timestamp', 'services', 'source', 'tried', 'attempts',
+               'last_try', 'last_success', 'quality', 'bucket', 'index')
+  
+  def __init__(self, address, timestamp, services, source):
+    self.address = address
+    self.timestamp = timestamp
+    self.services = services
+    self.source = source      # ip which told us this address, None for ourself
+    self.tried = False
+    self.attempts = 0
+    self.last_try = 0
+    self.last_success = 0
+    self.quality = None       # peer.quality when last connected, not saved
+    self.bucket = None        # index of bucket in its table
+    self.index = None         # position in the flat list of its table
+  
+  def terrible(self, now):
+    if self.last_try and now - self.last_try < RETRY_SECONDS:
+      return False            # just tried, give it a chance
+    if self.timestamp > now + MAX_FUTURE_SECONDS:
+      return True             # flying DeLorean, it would stay the most recent forever
+    if self.timestamp < now - HORIZON_DAYS * 86400:
+      return True             # not seen recently
+    if not self.last_success and self.attempts >= MAX_RETRIES:
+      return True             # never connected
+    if self.attempts >= MAX_FAILURES:
+      return True             # failed too many times since last success
+    return False
+  
+  def retry_at(self):         # exponential backoff after failed attempts
+    if not self.attempts: return 0
+    return self.last_try + min(RETRY_SECONDS << min(self.attempts - 1,6),MAX_RETRY_SECONDS)
+  
+  def chance(self):           # relative chance of being selected to dial
+    chance = 0.66 ** min(self.attempts,8)
+    if self.last_success:     # it worked before
+      chance *= 2.0
+    if self.quality is not None:
+      chance *= 0.5 + self.quality
+    return chance
+
+class _Table(object):
+  'Fixed buckets plus a flat list of all entries for O(1) random choice'
+  
+  def __init__(self, count):
+    self.buckets = [[] for i in range(count)]
+    self.entries = []
+  
+  def insert(self, entry, bucket):
+    entry.bucket = bucket
+    entry.index = len(self.entries)
+    self.buckets[bucket].append(entry)
+    self.entries.append(entry)
+  
+  def remove(self, entry):
+    self.buckets[entry.bucket].remove(entry)  # at most BUCKET_SIZE
+    
+    last = self.entries.pop()  # swap with the last one
+    if last is not entry:
+      self.entries[entry.index] = last
+      last.index = entry.index
+    entry.bucket = entry.index = None
+
+class AddressManager(object):
+  '''Addresses of peers in two tables like bitcoin's addrman: "new" ones
+     we only heard of, bucketed by the network group of who told us, and
+     "tried" ones we connected to, bucketed by their own group. A full
+     bucket evicts its worst entry, so no source can take over the table
+     and good peers are not pushed out by gossip.
+     
+     It also works as a read only mapping of (ip,port) to
+     (timestamp,services), and it is saved to a compact binary file.'''
+  
+  def __init__(self, key=None):
+    self._key = key or os.urandom(32)  # keeps bucket placement unpredictable
+    self._entries = dict()             # map of (ip,port) to _Entry
+    self._new = _Table(NEW_BUCKET_COUNT)
+    self._tried = _Table(TRIED_BUCKET_COUNT)
+    
+    # the most recent addresses for getaddr: a min-heap of (timestamp,address)
+    # with lazy deletion, and map of member address to its indexed timestamp
+    self._recent = None       # not built yet or invalidated
+    self._recent_members = dict()
+    self._recent_count = 0
+    self._recent_changes = 0  # bumped whenever the recent addresses change
+  
+  def _hash(self, *items):
+    data = self._key + '|'.join(str(i) for i in items).encode('utf-8')
+    return struct.unpack('<Q',hashlib.sha256(data).digest()[:8])[0]
+  
+  def _new_bucket(self, entry):
+    source = network_group(entry.source) if entry.source else 'self'
+    slot = self._hash(network_group(entry.address[0]),source) % NEW_BUCKETS_PER_SOURCE
+    return self._hash('new',source,slot) % NEW_BUCKET_COUNT
+  
+  def _tried_bucket(self, entry):
+    slot = self._hash(entry.address) % TRIED_BUCKETS_PER_GROUP
+    return self._hash('tried',network_group(entry.address[0]),slot) % TRIED_BUCKET_COUNT
+  
+  def _place_new(self, entry, now):
+    bucket = self._new_bucket(entry)
+    entries = self._new.buckets[bucket]
+    if len(entries) >= BUCKET_SIZE:  # evict the worst, terrible one first then the oldest
+      worst = min(entries,key=lambda e: (not e.terrible(now),e.timestamp))
+      self._new.remove(worst)
+      del self._entries[worst.address]
+      self._unindex(worst)
+    entry.tried = False
+    self._new.insert(entry,bucket)
+  
+  def _place_tried(self, entry, now):
+    bucket = self._tried_bucket(entry)
+    entries = self._tried.buckets[bucket]
+    if len(entries) >= BUCKET_SIZE:  # the displaced one goes back to new table
+      worst = min(entries,key=lambda e: e.last_success)
+      self._tried.remove(worst)
+      self._place_new(worst,now)
+    entry.tried = True
+    self._tried.insert(entry,bucket)
+  
+  def add(self, address, timestamp, services, source=None):
+    '''Adds or refreshes address (ip,port) heard from source ip, returns
+       True if it is a new one.'''
+    
+    if _ip_format.validate(address[0]) is None or not address[1]:
+      return False
+    
+    now = time.time()
+    if timestamp <= MIN_TIMESTAMP or timestamp > now + MAX_FUTURE_SECONDS:
+      timestamp = now - UNKNOWN_AGE_DAYS * 86400  # else it would head the recent ones forever
+    
+    entry = self._entries.get(address)
+    if entry is not None:
+      if timestamp > entry.timestamp:
+        entry.timestamp = min(timestamp,now)
+      old_services = entry.services
+      if services:
+        entry.services = services if old_services is None else (old_services | services)
+      self._index(entry,entry.services != old_services)
+      return False
+    
+    entry = _Entry(address,timestamp,services,source)
+    self._entries[address] = entry
+    self._place_new(entry,now)
+    self._index(entry)
+    return True
+  
+  def attempt(self, address):  # we are dialing it
+    entry = self._entries.get(address)
+    if entry is not None:
+      entry.last_try = time.time()
+      entry.attempts += 1
+  
+  def good(self, address, services=None):  # connected and handshaked, move it to tried table
+    entry = self._entries.get(address)
+    if entry is None:
+      return
+    
+    now = time.time()
+    entry.timestamp = entry.last_success = now
+    entry.attempts = 0
+    old_services = entry.services
+    if services is not None:
+      entry.services = services
+    if not entry.tried:
+      self._new.remove(entry)
+      self._place_tried(entry,now)
+    self._index(entry,entry.services != old_services)
+  
+  def failed(self, address):  # a dial or handshake failed, drop it if hopeless
+    entry = self._entries.get(address)
+    if entry is not None and entry.terrible(time.time() + RETRY_SECONDS):  # no grace of just tried
+      self.remove(address)
+  
+  def rate(self, address, quality):  # quality of its last connection, see Peer.quality
+    entry = self._entries.get(address)
+    if entry is not None:
+      entry.quality = quality
+  
+  def remove(self, address):
+    entry = self._entries.pop(address,None)
+    if entry is not None:
+      (self._tried if entry.tried else self._new).remove(entry)
+      self._unindex(entry)
+  
+  def select(self, exclude=(), new_only=False, groups=()):
+    '''Returns a random address to dial, half from each table when both
+       have entries, or None. Addresses in exclude (such as connected ones),
+       in network groups of groups or backing off after failures are
+       skipped. The rest are taken by their chance(), so the ones failing
+       since last success are picked less often.'''
+    
+    now = time.time()
+    factor = 1.0
+    for i in range(SELECT_TRIES):
+      tried = self._tried.entries
+      new = self._new.entries
+      if new_only or not tried:
+        table = new
+      elif not new:
+        table = tried
+      else: table = tried if random.random() < 0.5 else new
+      if not table: return None
+      
+      entry = random.choice(table)
+      if entry.address in exclude: continue
+      if entry.retry_at() > now: continue
+      if groups and network_group(entry.address[0]) in groups: continue
+      if random.random() < factor * entry.chance():
+        return entry.address
+      factor *= 1.2           # make sure to pick one in the end
+    return None
+  
+  # recency index
+  
+  def _index(self, entry, services_changed=False):  # entry added or refreshed, keep it if among the most recent
+    heap = self._recent
+    if heap is None: return
+    
+    address = entry.address
+    timestamp = entry.timestamp
+    members = self._recent_members
+    if entry.services is None:  # not shared until we know its services
+      pass
+    elif address in members:
+      if timestamp < members[address]:  # good() of an address announced with future time
+        self._unindex(entry)
+        return
+      if members[address] != timestamp:
+        members[address] = timestamp  # the old tuple in heap becomes stale
+        heapq.heappush(heap,(timestamp,address))
+        self._recent_changes += 1
+      elif services_changed:
+        self._recent_changes += 1     # a re-announcement with nothing new keeps the cached reply
+    elif len(members) < self._recent_count:
+      members[address] = timestamp
+      heapq.heappush(heap,(timestamp,address))
+      self._recent_changes += 1
+    else:
+      self._drop_stale()
+      if heap and timestamp > heap[0][0]:
+        (oldest, gone) = heapq.heapreplace(heap,(timestamp,address))
+        del members[gone]
+        members[address] = timestamp
+        self._recent_changes += 1
+    
+    if len(heap) > 2 * self._recent_count + 16:  # too many stale ones
+      heap[:] = [(t,a) for (a,t) in members.items()]
+      heapq.heapify(heap)
+  
+  def _unindex(self, entry):  # a member gone, rebuild from all entries on next recent()
+    if entry.address in self._recent_members:
+      self._recent = None
+      self._recent_members = dict()
+      self._recent_changes += 1
+  
+  def _drop_stale(self):
+    heap = self._recent
+    members = self._recent_members
+    while heap and members.get(heap[0][1]) != heap[0][0]:
+      heapq.heappop(heap)
+  
+  def recent(self, count):
+    '''Returns list of (address,timestamp,services) of the count most recent
+       addresses with known services, newest first. The index is kept up to
+       date by add() and good(), only a removal of its member or a different
+       count rebuilds it.'''
+    
+    if self._recent is None or count != self._recent_count:
+      top = heapq.nlargest(count,((e.timestamp,a) for (a,e) in self._entries.items() if e.services is not None))
+      self._recent = top[::-1]  # ascending is a valid min-heap
+      self._recent_members = dict((a,t) for (t,a) in top)
+      self._recent_count = count
+      self._recent_changes += 1
+    
+    members = self._recent_members
+    entries = self._entries
+    return [(a,t,entries[a].services) for (a,t) in sorted(members.items(),key=lambda i: -i[1])]
+  
+  recent_changes = property(lambda s: s._recent_changes)  # compare with the last one to reuse a message built from recent()
+  
+  new_count = property(lambda s: len(s._new.entries))
+  tried_count = property(lambda s: len(s._tried.entries))
+  
+  # read only mapping of (ip,port) to (timestamp,services)
+  
+  def __len__(self):
+    return len(self._entries)
+  
+  def __contains__(self, address):
+    return address in self._entries
+  
+  def __iter__(self):
+    return iter(self._entries)
+  
+  def __getitem__(self, address):
+    entry = self._entries[address]
+    return (entry.timestamp,entry.services)
+  
+  def get(self, address, default=None):
+    entry = self._entries.get(address)
+    if entry is None: return default
+    return (entry.timestamp,entry.services)
+  
+  def items(self):
+    return [(a,(e.timestamp,e.services)) for (a,e) in self._entries.items()]
+  
+  # persistence
+  
+  def save(self, path):
+    '''Writes all entries to path, replaced atomically.'''
+    
+    records = []
+    for entry in self._entries.values():
+      (ip, port) = entry.address
+      source = _ip_format.binary(entry.source) if entry.source else _NO_SOURCE
+      records.append(_RECORD.pack(_ip_format.binary(ip),port,source,int(entry.timestamp),
+          entry.services or 0,int(entry.last_try),int(entry.last_success),
+          min(entry.attempts,0xffff),1 if entry.tried else 0))
+    
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    # a temporary file of this process, cluster workers may save the same path at once
+    (fd, temp) = tempfile.mkstemp(prefix=os.path.basename(path) + '.',suffix='.tmp',dir=directory or '.')
+    try:
+      with os.fdopen(fd,'wb') as f:
+        f.write(_FILE_MAGIC + struct.pack('<BI',_FILE_VERSION,len(records)) + self._key)
+        f.write(b''.join(records))
+      if hasattr(os,'replace'):
+        os.replace(temp,path)
+      else: os.rename(temp,path)  # python2, atomic on posix
+    except Exception as e:  # leave no temporary file behind
+      os.remove(temp)
+      raise
+  
+  @classmethod
+  def load(cls, path):
+    '''Returns the manager saved in path, an empty one if no such file or
+       it is not readable.'''
+    
+    try:
+      with open(path,'rb') as f:
+        data = f.read()
+    except (IOError, OSError) as e:
+      return cls()
+    
+    head = len(_FILE_MAGIC) + 5
+    if data[:len(_FILE_MAGIC)] != _FILE_MAGIC or len(data) < head + 32:
+      return cls()
+    (version, count) = struct.unpack_from('<BI',data,len(_FILE_MAGIC))
+    if version != _FILE_VERSION:
+      return cls()
+    
+    self = cls(data[head:head + 32])
+    now = time.time()
+    offset = head + 32
+    for i in range(count):
+      if offset + _RECORD.size > len(data): break  # truncated, keep what we have
+      (ip, port, source, timestamp, services, last_try, last_success, attempts, tried) = _RECORD.unpack_from(data,offset)
+      offset += _RECORD.size
+      
+      address = (_ip_format.parse(ip)[1],port)
+      if address in self._entries: continue
+      entry = _Entry(address,timestamp,services,None if source == _NO_SOURCE else _ip_format.parse(source)[1])
+      entry.last_try = last_try
+      entry.last_success = last_success
+      entry.attempts = attempts
+      if entry.terrible(now): continue
+      
+      self._entries[address] = entry
+      if tried:
+        self._place_tried(entry,now)
+      else: self._place_new(entry,now)
+    return self
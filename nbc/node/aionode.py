@@ -0,0 +1,249 @@
+import asyncio
+import errno
+import sys
+import time
+import traceback
+
+from .. import coins
+from .core import NodeCore
+from .peer import Peer, SEND_HIGH_WATER, SEND_LOW_WATER
+from ..node import AddrInUseError, StopNode, add_portmap, remove_portmap
+
+CONNECT_TIMEOUT = 10    # seconds to wait an outgoing connection established
+TICK_INTERVAL = 1       # seconds between calling begin_loop()
+LISTEN_BACKLOG = 128
+
+class AioConnection(Peer, asyncio.BufferedProtocol):
+  'Connection of AioNode, received data goes straight into the receive buffer'
+  
+  def __init__(self, node, address=None, incoming=False):
+    Peer.__init__(self,node,address,incoming)
+    self._transport = None
+    self._pending = []    # data sent before connection made
+    self._closed = False
+    
+    if not incoming:      # incoming one is added after its address checked
+      node._add_connection(self)
+      self._send_version()
+  
+  @property
+  def send_queued(self):
+    if self._transport is None:
+      return sum(len(data) for data in self._pending)
+    return self._transport.get_write_buffer_size()
+  
+  async def _dial(self):
+    loop = self.node.loop
+    try:
+      await asyncio.wait_for(loop.create_connection(lambda: self,self.ip,self.port),CONNECT_TIMEOUT)
+    except Exception as e:
+      self.node.log('--- connection refused',peer=self,level=self.node.LOG_LEVEL_INFO)
+      self.handle_close()
+  
+  def connection_made(self, transport):
+    if self._incoming:
+      self._address = transport.get_extra_info('peername')[:2]
+      if not self.node._accept_incoming(self._address):
+        self._closed = True
+        self._pending = None
+        transport.close()
+        return
+      self.node._add_connection(self)
+    elif self._closed:    # closed while dialing
+      transport.close()
+      return
+    
+    self._transport = transport
+    transport.set_write_buffer_limits(SEND_HIGH_WATER,SEND_LOW_WATER)
+    pending = self._pending
+    self._pending = None
+    for data in pending:
+      self._write(data)
+    if self._incoming:
+      self._send_version()
+    self._start_timers()
+  
+  def get_buffer(self, sizehint):
+    size = self._block_size
+    self._reserve_recv(size)
+    return memoryview(self._recv_buffer)[self._recv_end:self._recv_end + size]
+  
+  def buffer_updated(self, nbytes):
+    profiler = self.node._profiler
+    if profiler is None:
+      self._received(nbytes)
+      return
+    started = profiler.start()
+    try:
+      self._received(nbytes)
+    finally:
+      profiler.stop('read',started)
+  
+  def eof_received(self):
+    return False          # let transport close itself
+  
+  def pause_writing(self):
+    self._set_congested(True)
+  
+  def resume_writing(self):
+    self._set_congested(False)
+  
+  def _update_reading(self):
+    # stop taking requests from a peer that does not read our responses,
+    # or sends them faster than the worker pool handles
+    if self._closed or self._transport is None: return
+    if self._congested or self._backlogged:
+      self._transport.pause_reading()
+    else: self._transport.resume_reading()
+  
+  def connection_lost(self, exc):
+    self._closed_down()
+  
+  def _closed_down(self):
+    if self._transport is None and self._pending is None: return  # already done
+    self._closed = True
+    self._cancel_timers()
+    self._cancel_jobs()
+    self._transport = self._pending = None
+    self.node._remove_connection(self)
+    self.node.disconnected(self)
+  
+  def handle_close(self):
+    self._closed = True
+    if self._transport is not None:
+      self._transport.close()   # connection_lost() will follow
+    else: self._closed_down()
+  
+  def _write(self, data):
+    if self._transport is None:
+      if self._pending is not None:
+        self._pending.append(data)
+      return
+    if self._closed: return
+    
+    self._transport.write(data)
+    self._tx_bytes += len(data)
+    self.node._tx_bytes += len(data)
+    self._last_tx_time = time.time()
+
+class AioNode(NodeCore):
+  '''Node running on asyncio (epoll/kqueue backed), the same command_xxx
+     contract as BaseNode. Heartbeat, ping and idle timeout are timers of
+     the event loop rather than polling every peer in each loop iteration.
+     
+     Run it with serve_forever(), or await run() inside an existing loop.'''
+  
+  def __init__(self, data_dir=None, address=None, seek_peers=16, max_peers=125, bootstrap=True, log=sys.stdout, coin=coins.Newbitcoin, reuse_port=False):
+    NodeCore.__init__(self,data_dir,address,seek_peers,max_peers,bootstrap,log,coin)
+    self._reuse_port = reuse_port
+    self._loop = None
+    self._server = None
+    self._stopped = None
+    self._tick = None
+  
+  loop = property(lambda s: s._loop)
+  
+  def call_later(self, delay, callback, *args):
+    return self._loop.call_later(delay,self._run_timer,callback,args)
+  
+  def call_soon_threadsafe(self, callback, *args):
+    if self._loop.is_closed(): return  # a late job of a stopped node
+    self._loop.call_soon_threadsafe(self._run_timer,callback,args)
+  
+  def _run_timer(self, callback, args):
+    try:
+      callback(*args)
+    except StopNode as e:
+      self.stop()
+    except Exception as e:
+      self.log(traceback.format_exc(),level=self.LOG_LEVEL_ERROR)
+  
+  def _add_reader(self, fd, callback):
+    self._loop.add_reader(fd,self._run_timer,callback,())
+  
+  def _remove_reader(self, fd):
+    if self._loop is not None: self._loop.remove_reader(fd)
+  
+  def _add_connection(self, connection):
+    self._registry.add(id(connection),connection)
+  
+  def _remove_connection(self, connection):
+    self._registry.remove(id(connection))
+  
+  def _connect(self, address):
+    if self._loop is None:
+      raise RuntimeError('node not started')
+    connection = AioConnection(self,address,False)
+    self._loop.create_task(connection._dial())
+  
+  async def start(self):
+    self._loop = asyncio.get_event_loop()
+    self._stopped = self._loop.create_future()
+    
+    if self._listen:
+      try:
+        self._server = await self._loop.create_server(lambda: AioConnection(self,None,True),
+            self.ip, self.port, reuse_address=True, reuse_port=self._reuse_port or None, backlog=LISTEN_BACKLOG)
+      except OSError as e:  # port in use... Maybe already running
+        if e.errno == errno.EADDRINUSE:
+          raise AddrInUseError()
+        raise e
+      
+      if self.port == 0: # if bound to a random port, keep track
+        self._address = self._server.sockets[0].getsockname()[:2]
+      self._upnp = await self._loop.run_in_executor(None,add_portmap,self.port,'TCP','Newbitcoin Peer manager')
+    
+    self._attach_cluster()
+    self._tick = self._loop.call_soon(self._on_tick)
+    self.call_later(0,self._on_heartbeat)
+  
+  def _on_tick(self):
+    self._run_timer(self.begin_loop,())
+    self._tick = self._loop.call_later(TICK_INTERVAL,self._on_tick)
+  
+  async def run(self):
+    await self.start()
+    try:
+      await self._stopped
+    finally:
+      self.handle_close()
+      
+      if self._listen:
+        remove_portmap(self.port,'TCP')
+  
+  def serve_forever(self):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+      loop.run_until_complete(self.run())
+    except StopNode as e:
+      pass
+    finally:
+      loop.close()
+  
+  def stop(self):  # can be called from other thread
+    def done():
+      if not self._stopped.done():
+        self._stopped.set_result(None)
+    if self._loop is not None and self._stopped is not None:
+      self._loop.call_soon_threadsafe(done)
+  
+  close = stop
+  
+  def handle_close(self):
+    for timer in (self._tick, self._heartbeat_timer):
+      if timer: timer.cancel()
+    self._tick = self._heartbeat_timer = None
+    if self._server:
+      self._server.close()
+      self._server = None
+    for peer in self.peers:
+      peer.handle_close()
+    self._closing()
+
+# from nbc.node import aionode, core
+# node = aionode.AioNode(address=('127.0.0.1',30303))
+# node.log_level = node.LOG_LEVEL_DEBUG
+# core.startServer(node)
+#
+# node.close()
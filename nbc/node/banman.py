@@ -0,0 +1,213 @@
+import heapq
+import os
+import tempfile
+import time
+from binascii import hexlify, unhexlify
+
+from ..protocol import format
+
+__all__ = ['BanManager', 'parse_subnet']
+
+_ip_format = format.FtIPAddress()
+_FULL = (1 << 128) - 1
+
+def _ip_bits(ip):  # ip as 128 bits integer, IPv4 is mapped into ::ffff:0:0/96, None if not an ip
+  try:
+    return int(hexlify(_ip_format.binary(ip)),16)
+  except (ValueError, TypeError) as e:
+    return None
+
+def _mask(length):
+  return _FULL ^ (_FULL >> length)
+
+def parse_subnet(subnet):
+  '''Returns (bits,length) of 'ip' or 'ip/prefix' such as '10.1.0.0/16',
+     the prefix of IPv4 counts its 32 bits. Raises ValueError if invalid.'''
+  
+  (ip, slash, prefix) = subnet.partition('/')
+  bits = _ip_bits(ip)
+  if bits is None:
+    raise ValueError('invalid subnet: %r' % subnet)
+  
+  full = 128 if ':' in ip else 32
+  length = int(prefix) if slash else full
+  if not (0 <= length <= full):
+    raise ValueError('invalid subnet: %r' % subnet)
+  length += 128 - full
+  return (bits & _mask(length),length)
+
+def _subnet_text(bits, length):  # normalized text of (bits,length)
+  ip = _ip_format.parse(unhexlify('%032x' % bits))[1]
+  if '.' in ip:
+    length -= 96
+  return '%s/%d' % (ip,length)
+
+class _Node(object):
+  __slots__ = ('bits', 'length', 'until', 'children')
+  
+  def __init__(self, bits, length, until=None):
+    self.bits = bits          # prefix, the bits after length are zero
+    self.length = length
+    self.until = until        # expiry of the ban of this prefix, None for a branch only node
+    self.children = [None, None]
+
+def _bit(bits, index):        # bit at index, 0 is the most significant one
+  return (bits >> (127 - index)) & 1
+
+def _common(a, b, length):    # length of the common prefix of a and b, at most length
+  diff = (a ^ b) & _mask(length)
+  if not diff: return length
+  return 128 - diff.bit_length()
+
+class BanManager(object):
+  '''Banned IPv4 and IPv6 subnets in a path compressed binary trie (radix
+     tree), so checking an ip walks only the prefixes above it, however
+     many bans there are. Each ban has an expiry, the earliest one is
+     known from a heap for the node to schedule a timer.'''
+  
+  def __init__(self):
+    self._root = _Node(0,0)
+    self._bans = dict()     # map of (bits,length) to expiry
+    self._expiry = []       # heap of (until,bits,length), lazy deleted
+  
+  def __len__(self):
+    return len(self._bans)
+  
+  def __contains__(self, subnet):
+    return parse_subnet(subnet) in self._bans
+  
+  def bans(self):  # list of (subnet,until), earliest expiry first
+    return sorted(((_subnet_text(b,l),u) for ((b, l), u) in self._bans.items()),key=lambda i: i[1])
+  
+  def ban(self, subnet, until):  # ban or extend a ban till time until
+    (bits, length) = parse_subnet(subnet)
+    self._bans[(bits,length)] = until
+    heapq.heappush(self._expiry,(until,bits,length))
+    
+    node = self._root
+    while True:
+      if node.length == length:  # bits are equal here
+        node.until = until
+        return
+      
+      bit = _bit(bits,node.length)
+      child = node.children[bit]
+      if child is None:
+        node.children[bit] = _Node(bits,length,until)
+        return
+      
+      common = _common(bits,child.bits,min(length,child.length))
+      if common == child.length:  # child is a prefix of it, go deeper
+        node = child
+        continue
+      
+      if common == length:        # it is a prefix of child
+        new = _Node(bits,length,until)
+      else:                       # they fork after common bits
+        new = _Node(bits & _mask(common),common)
+        new.children[_bit(bits,common)] = _Node(bits,length,until)
+      new.children[_bit(child.bits,common)] = child
+      node.children[bit] = new
+      return
+  
+  def unban(self, subnet):  # returns False if not banned
+    (bits, length) = parse_subnet(subnet)
+    if self._bans.pop((bits,length),None) is None:
+      return False
+    self._remove(bits,length)
+    return True
+  
+  def _remove(self, bits, length):
+    path = []
+    node = self._root
+    while node.length != length:
+      path.append(node)
+      node = node.children[_bit(bits,node.length)]
+    node.until = None
+    
+    # drop the nodes no longer needed, a branch only node keeps two children
+    while path:
+      children = [c for c in node.children if c is not None]
+      if node.until is not None or len(children) == 2: break
+      parent = path.pop()
+      parent.children[_bit(node.bits,parent.length)] = children[0] if children else None
+      node = parent
+  
+  def is_banned(self, ip, now=None):
+    bits = _ip_bits(ip)
+    if bits is None: return False
+    if now is None: now = time.time()
+    
+    node = self._root
+    while node is not None:
+      if (bits ^ node.bits) & _mask(node.length):  # out of this prefix
+        return False
+      if node.until is not None and node.until > now:
+        return True
+      if node.length == 128: return False
+      node = node.children[_bit(bits,node.length)]
+    return False
+  
+  def next_expiry(self):  # earliest expiry, None if no ban
+    heap = self._expiry
+    while heap:
+      (until, bits, length) = heap[0]
+      if self._bans.get((bits,length)) == until: return until
+      heapq.heappop(heap)    # unbanned or extended
+    return None
+  
+  def expire(self, now=None):  # removes the expired bans, returns their subnets
+    if now is None: now = time.time()
+    expired = []
+    while True:
+      until = self.next_expiry()
+      if until is None or until > now: break
+      (until, bits, length) = heapq.heappop(self._expiry)
+      del self._bans[(bits,length)]
+      self._remove(bits,length)
+      expired.append(_subnet_text(bits,length))
+    return expired
+  
+  # persistence, a text file of 'subnet until' lines
+  
+  def save(self, path):
+    '''Writes all bans to path, replaced atomically.'''
+    
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    # a unique temporary name, another cluster worker may be saving bans too
+    (fd, temp) = tempfile.mkstemp(prefix=os.path.basename(path) + '.',suffix='.tmp',dir=directory or '.')
+    try:
+      with os.fdopen(fd,'w') as f:
+        for (subnet, until) in self.bans():
+          f.write('%s %d\n' % (subnet,until))
+      if hasattr(os,'replace'):
+        os.replace(temp,path)
+      else: os.rename(temp,path)  # python2, atomic on posix
+    except Exception as e:
+      os.remove(temp)
+      raise
+  
+  @classmethod
+  def load(cls, path):
+    '''Returns the bans saved in path without the expired ones, an empty
+       manager if no such file. Malformed lines are skipped.'''
+    
+    self = cls()
+    try:
+      with open(path) as f:
+        lines = f.readlines()
+    except (IOError, OSError) as e:
+      return self
+    
+    now = time.time()
+    for line in lines:
+      try:
+        (subnet, until) = line.split()
+        until = int(until)
+        if until > now:
+          self.ban(subnet,until)
+      except ValueError as e:
+        continue
+    return self
@@ -0,0 +1,66 @@
+import math
+import os
+import struct
+
+__all__ = ['RollingBloomFilter']
+
+GENERATIONS = 3         # the oldest one is cleared when the newest is full
+
+_pair = struct.Struct('<QQ')
+
+class RollingBloomFilter(object):
+  '''Remembers at least the last capacity items in fixed memory, with a
+     false positive rate of about fp_rate and no false negatives for them.
+     Items go into the newest of GENERATIONS bloom filters, when it holds
+     capacity / (GENERATIONS - 1) items the oldest one is cleared and
+     becomes the newest, so older items are forgotten a generation at a
+     time instead of one by one.
+     
+     Items are hashes (such as of inventory) of at least 16 bytes, their
+     bits are used directly, mixed with a random tweak of this filter.'''
+  
+  def __init__(self, capacity, fp_rate=0.000001):
+    per_generation = max(1,capacity // (GENERATIONS - 1))
+    rate = fp_rate / GENERATIONS   # any generation may give a false positive
+    bits = int(math.ceil(-per_generation * math.log(rate) / (math.log(2) ** 2)))
+    self._bytes = (bits + 7) // 8
+    self._bits = self._bytes * 8
+    self._hashes = max(1,int(round(self._bits * math.log(2) / per_generation)))
+    self._limit = per_generation
+    (self._tweak1, self._tweak2) = _pair.unpack(os.urandom(16))
+    
+    self._generations = [bytearray(self._bytes) for i in range(GENERATIONS)]
+    self._newest = 0
+    self._count = 0      # items added to the newest generation
+  
+  memory = property(lambda s: s._bytes * GENERATIONS)
+  
+  def _indexes(self, item):
+    (a, b) = _pair.unpack_from(item)
+    a ^= self._tweak1
+    b = (b ^ self._tweak2) | 1
+    size = self._bits
+    return [(a + i * b) % size for i in range(self._hashes)]
+  
+  def add(self, item):
+    if self._count >= self._limit:
+      self._newest = (self._newest + 1) % GENERATIONS
+      self._generations[self._newest] = bytearray(self._bytes)
+      self._count = 0
+    self._count += 1
+    
+    bits = self._generations[self._newest]
+    for index in self._indexes(item):
+      bits[index >> 3] |= 1 << (index & 7)
+  
+  def __contains__(self, item):
+    indexes = self._indexes(item)
+    for bits in self._generations:
+      for index in indexes:
+        if not bits[index >> 3] & (1 << (index & 7)): break
+      else: return True
+    return False
+  
+  def clear(self):
+    self._generations = [bytearray(self._bytes) for i in range(GENERATIONS)]
+    self._count = 0
@@ -0,0 +1,223 @@
+import multiprocessing
+import select
+import socket
+import sys
+from collections import deque
+
+from six import string_types
+
+from ..node import StopNode, set_reuse_port
+
+__all__ = ['Cluster', 'WorkerChannel']
+
+MAX_KNOWN_INVENTORY = 50000  # inventory hashes remembered by each worker
+
+def _stop_node():
+  raise StopNode()
+
+class WorkerChannel(object):
+  '''End of the IPC channel inside a worker process. The node of a worker
+     shares what it learns with other workers through it: addresses (done
+     by NodeCore), known inventory and chain tip (done by sub-class with
+     add_inventory() and set_tip()).
+     
+     Every item is a small tuple pickled through a pipe, the parent process
+     relays it to all other workers.'''
+  
+  def __init__(self, conn, index):
+    self._conn = conn
+    self._index = index
+    self._node = None
+    
+    self._inventory = set()
+    self._inventory_order = deque()  # forget oldest one when over MAX_KNOWN_INVENTORY
+    self._tip = (0,None)             # (height,hash) of best chain seen by any worker
+  
+  index = property(lambda s: s._index)
+  tip = property(lambda s: s._tip)
+  
+  def attach(self, node):
+    self._node = node
+    node._cluster = self
+  
+  def fileno(self):
+    return self._conn.fileno()
+  
+  def _send(self, *item):
+    try:
+      self._conn.send(item)
+    except (EOFError, IOError, OSError) as e:
+      pass  # parent gone, it will stop us soon
+  
+  def share_addresses(self, addresses):
+    self._send('addresses',addresses)
+  
+  def add_inventory(self, hashes, share=True):  # returns the hashes not known before
+    added = []
+    for h in hashes:
+      if h in self._inventory: continue
+      self._inventory.add(h)
+      self._inventory_order.append(h)
+      added.append(h)
+    
+    while len(self._inventory_order) > MAX_KNOWN_INVENTORY:
+      self._inventory.discard(self._inventory_order.popleft())
+    
+    if share and added:
+      self._send('inventory',added)
+    return added
+  
+  def has_inventory(self, h):
+    return h in self._inventory
+  
+  def set_tip(self, height, hash, share=True):
+    if height <= self._tip[0]: return False
+    self._tip = (height,hash)
+    if share:
+      self._send('tip',height,hash)
+    return True
+  
+  def receive(self):  # called by the node's event loop when the pipe is readable
+    node = self._node
+    try:
+      while self._conn.poll():
+        item = self._conn.recv()
+        kind = item[0]
+        if kind == 'addresses':
+          node._merge_addresses(item[1])
+        elif kind == 'inventory':
+          self.add_inventory(item[1],False)
+        elif kind == 'tip':
+          self.set_tip(item[1],item[2],False)
+        elif kind == 'stop':
+          node.call_later(0,_stop_node)
+    except (EOFError, IOError, OSError) as e:  # parent is gone
+      node._remove_reader(self.fileno())
+      node.call_later(0,_stop_node)
+
+def _run_worker(node_class, address, kwargs, conn, index):
+  log = None
+  if isinstance(kwargs.get('log'),string_types):  # a path, each worker appends to it
+    log = kwargs['log'] = open(kwargs['log'],'a',1)
+  
+  node = node_class(address=address,reuse_port=True,**kwargs)
+  WorkerChannel(conn,index).attach(node)
+  try:
+    node.serve_forever()
+  except KeyboardInterrupt as e:
+    pass
+  finally:
+    if log is not None: log.close()
+
+class Cluster(object):
+  '''Runs one node per worker process, all of them listening on the same
+     port with SO_REUSEPORT so the kernel spreads incoming peers across
+     processes (and cores). Each worker has its own event loop and peers,
+     this process only relays the shared state between workers.
+     
+       cluster = Cluster(basenode.BaseNode,('0.0.0.0',30303),workers=4)
+       cluster.serve_forever()
+     
+     Extra keyword arguments are passed to node_class. seek_peers is split
+     among workers so the cluster makes about as many outgoing connections
+     as a single node, max_peers applies to each worker. They must be
+     picklable for the spawn start method, so log is a file path (or None)
+     rather than a stream.
+     
+     Linux only: SO_REUSEPORT on macOS and BSD does not balance accepting,
+     one worker would get every incoming peer.'''
+  
+  def __init__(self, node_class, address, workers=None, **kwargs):
+    if not sys.platform.startswith('linux'):
+      raise RuntimeError('cluster mode needs Linux to balance incoming peers across workers')
+    log = kwargs.get('log')
+    if log is not None and not isinstance(log,string_types):
+      raise TypeError('log of a cluster should be a file path or None')
+    
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+    self._node_class = node_class
+    self._workers = workers
+    self._kwargs = kwargs
+    
+    seek_peers = kwargs.get('seek_peers',16)
+    kwargs['seek_peers'] = max(1,(seek_peers + workers - 1) // workers)
+    
+    # bind (not listen) the port in this process, so a random port can be known
+    # before workers start
+    self._reserved = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    self._reserved.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    set_reuse_port(self._reserved)
+    self._reserved.bind(address)
+    self._address = self._reserved.getsockname()[:2]
+    
+    self._processes = dict()  # map of pipe to worker process
+  
+  address = property(lambda s: s._address)
+  workers = property(lambda s: s._workers)
+  
+  def start(self):
+    for index in range(self._workers):
+      (conn, child_conn) = multiprocessing.Pipe()
+      process = multiprocessing.Process(target=_run_worker,name='nbc-worker-%d' % index,
+          args=(self._node_class,self._address,self._kwargs,child_conn,index))
+      process.daemon = True
+      process.start()
+      child_conn.close()  # so we see EOF when worker exits
+      self._processes[conn] = process
+  
+  def _relay(self, source, item):
+    for conn in list(self._processes):
+      if conn is source: continue
+      try:
+        conn.send(item)
+      except (EOFError, IOError, OSError) as e:
+        self._lost(conn)
+  
+  def _lost(self, conn):
+    process = self._processes.pop(conn,None)
+    if process is None: return
+    conn.close()
+    process.join(1)
+    if process.exitcode:
+      sys.stderr.write('worker %s exited with code %s\n' % (process.name,process.exitcode))
+  
+  def serve_forever(self):
+    if not self._processes:
+      self.start()
+    
+    try:
+      while self._processes:
+        (readable, w, x) = select.select(list(self._processes),[],[])
+        for conn in readable:
+          try:
+            while conn in self._processes and conn.poll():
+              self._relay(conn,conn.recv())
+          except (EOFError, IOError, OSError) as e:
+            self._lost(conn)
+    except KeyboardInterrupt as e:
+      pass
+    finally:
+      self.close()
+  
+  def close(self, timeout=5):
+    for conn in list(self._processes):
+      try:
+        conn.send(('stop',))
+      except (EOFError, IOError, OSError) as e:
+        pass
+    
+    for (conn, process) in list(self._processes.items()):
+      process.join(timeout)
+      if process.is_alive():
+        process.terminate()
+      conn.close()
+    self._processes.clear()
+    
+    if self._reserved is not None:
+      self._reserved.close()
+      self._reserved = None
+
+# from nbc.node import basenode, cluster
+# c = cluster.Cluster(basenode.BaseNode,('0.0.0.0',30303),workers=4)
+# c.serve_forever()
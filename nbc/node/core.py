@@ -0,0 +1,545 @@
+import sys, os, time, random, logging
+from threading import Thread
+
+try:
+  from concurrent import futures
+except ImportError:  # python2 without the futures backport
+  futures = None
+
+from .. import util
+from .. import coins
+from .. import protocol
+from . import addrman
+from . import banman
+from . import dialer
+from . import download
+from . import logs
+from . import metrics
+from . import profiling
+from . import registry
+from . import throttle
+from .peer import MAX_INVENTORY
+
+try:
+  range = xrange
+except NameError as err:  # range same to xrange in python3
+  pass
+
+VERSION = [0,0,1]
+
+ADDRESSES_FILE = 'peers.dat'   # address manager saved in data_dir
+ADDRESSES_SAVE_INTERVAL = 900  # seconds between saving addresses
+ADDRESSES_PER_ASK = 1000  # maximun number of address returned when ask by peer
+
+HEARTBEAT_INTERVAL = 10   # seconds between heartbeat
+BAN_SECONDS = 3600        # how long a punished peer is banned
+BANS_FILE = 'banlist.dat' # bans saved in data_dir
+EVICT_MIN_SECONDS = 60    # inbound peers connected shorter are not evicted, they are not measured yet
+
+# logging levels of NodeCore.LOG_LEVEL_PROTOCOL ... LOG_LEVEL_FATAL
+_LOGGING_LEVELS = [logs.PROTOCOL, logging.DEBUG, logging.INFO, logging.ERROR, logging.CRITICAL]
+
+OFFLOAD_WORKERS = 4       # threads of the default pool for offloaded commands
+
+class NodeCore(object):
+  '''Node logic shared by the event loop runtimes (asyncore BaseNode and
+     asyncio AioNode): peers, addresses, heartbeat and the command_xxx
+     handlers. A runtime sub-class registers its connections in
+     self._registry (and keeps them in self._peers as it needs), and
+     implements _connect(address) and serve_forever().
+     
+     NodeCore does not validate transactions or blocks, so it relays none
+     by itself. A sub-class handling command_inventory and
+     command_transaction (or command_block) should call relay_inventory()
+     with the ones it accepted, which skips peers already knowing them and
+     trickles the announcements, see Peer.queue_inventory().'''
+  
+  LOG_LEVEL_PROTOCOL = 0
+  LOG_LEVEL_DEBUG    = 1
+  LOG_LEVEL_INFO     = 2
+  LOG_LEVEL_ERROR    = 3
+  LOG_LEVEL_FATAL    = 4
+  
+  def __init__(self, data_dir=None, address=None, seek_peers=16, max_peers=125, bootstrap=True, log=sys.stdout, coin=coins.Newbitcoin):
+    self._coin = coin
+    
+    if data_dir is None:
+      data_dir = util.default_data_directory()
+    self._data_dir = data_dir
+    
+    self._peers = dict()
+    self._registry = registry.PeerRegistry()  # peers indexed by address, ip and key in _peers
+    self._addresses_path = os.path.join(data_dir,ADDRESSES_FILE)
+    self._addresses = addrman.AddressManager.load(self._addresses_path)  # also a map of (address,port) to (timestamp,service)
+    self._addresses_saved = time.time()
+    self._address_message = None  # (recent_changes,Address) answering getaddr
+    
+    self._seek_peers = seek_peers
+    self._max_peers = max_peers
+    self._bootstrap = bootstrap
+    self._log = None       # logs.StreamLogger owned by node
+    if log is None:
+      self._logger = None
+    elif isinstance(log,logging.Logger):  # configured by application, such as structured handlers
+      self._logger = log
+    else:
+      self._log = logs.StreamLogger(log)
+      self._logger = self._log.logger
+    self._log_level = self.LOG_LEVEL_ERROR
+    
+    self._bootstrap = None
+    if bootstrap:
+      self._bootstrap = coin.dns_seeds[:]  # copy dns seeds
+    
+    self._bans_path = os.path.join(data_dir,BANS_FILE)
+    self._bans = banman.BanManager.load(self._bans_path)  # banned subnets, checked before accepting a connection
+    self._bans_changed = False
+    self._unban_timer = None  # fires at the earliest expiry of bans, the loaded ones are scheduled by heartbeat
+    self._unban_at = None
+    self._user_agent = '/nbc:%s(%s)/' % ('.'.join(str(i) for i in VERSION),coin.name)
+    self._heartbeat_timer = None
+    self._dialer = dialer.Dialer(self)  # keeps outgoing connections dialing while short of seek_peers
+    self._downloader = download.Downloader(self)  # getdata requests in flight, see download.Downloader
+    self._offload = dict()  # map 12 bytes command to (command,prepare,executor), see offload()
+    self._offload_executor = None
+    self._cluster = None  # channel to other worker processes when running in a cluster
+    
+    self._tx_bytes = 0    # total send bytes
+    self._rx_bytes = 0    # total receive bytes
+    self._metrics = metrics.Metrics()  # per command counters and latency, see metrics.render()
+    self._profiler = None  # profiling.Profiler of hot path stages when enabled
+    self._sampling = set() # kinds of on-demand sampling running, cProfile or tracemalloc
+    
+    self._listen = True
+    if address is None:
+      self._listen = False
+      address = ('127.0.0.1',0)
+    self._address = address
+    
+    self._guessed_external_ip = address[0]
+    self._external_ip = None
+    self._upnp = None
+    
+    # token buckets of each peer for relay commands, so a chatty peer can not take all CPU or bandwidth
+    self._relay_limits = dict()  # map 12 bytes command to (command,rate,burst), see set_relay_limit()
+    for (command, (rate, burst)) in throttle.RELAY_LIMITS.items():
+      self.set_relay_limit(command,rate,burst)
+  
+  coin = property(lambda s: s._coin)
+  data_dir = property(lambda s: s._data_dir)
+  seek_peers = property(lambda s: s._seek_peers)
+  bootstrap = property(lambda s: s._bootstrap)  # dns seeds, None for a router node
+  
+  # blockchain height will include when connecting to a peer, sub-class should override it
+  blockchain_height = 0
+  
+  address = property(lambda s: s._address)
+  ip = property(lambda s: s._address[0])
+  port = property(lambda s: s._address[1])
+  
+  def _get_external_ip(self):
+    if self._external_ip:
+      return self._external_ip
+    return self._guessed_external_ip
+  def _set_external_ip(self,address):
+    self._external_ip = address
+  external_ip = property(_get_external_ip,_set_external_ip)
+  
+  def _get_user_agent(self):
+    return self._user_agent
+  def _set_user_agent(self, user_agent):
+    self._user_agent = user_agent
+  user_agent = property(_get_user_agent,_set_user_agent)
+  
+  relay_limits = property(lambda s: dict((c,(r,b)) for (c,r,b) in s._relay_limits.values()))  # map of command to (rate,burst)
+  metrics = property(lambda s: s._metrics)
+  profiler = property(lambda s: s._profiler)
+  
+  # cluster.WorkerChannel sharing addresses, known inventory and chain tip, None for a single process node
+  cluster = property(lambda s: s._cluster)
+  
+  def _get_log_level(self):
+    return self._log_level
+  def _set_log_level(self, log_level):
+    self._log_level = log_level
+  log_level = property(_get_log_level,_set_log_level)
+  
+  logger = property(lambda s: s._logger)
+  
+  def log(self, message, *args, **kwargs):  # log(message, *args, peer=None, level=LOG_LEVEL_INFO)
+    '''Formatting message % args is deferred to the logging handler, for
+       StreamLogger that is its listener thread, so pass args rather than
+       formatting them. The record has peer (an address or None) as extra.'''
+    
+    level = kwargs.get('level',self.LOG_LEVEL_INFO)
+    if self._logger is None or level < self._log_level: return
+    
+    peer = kwargs.get('peer')
+    if peer:
+      source = peer.address[0]
+    else: source = 'node'
+    
+    extra = dict(peer=peer.address if peer else None)
+    if args:
+      self._logger.log(_LOGGING_LEVELS[level],'(%s) ' + message,source,*args,extra=extra)
+    else: self._logger.log(_LOGGING_LEVELS[level],'(%s) %s',source,message,extra=extra)
+  
+  def _closing(self):  # runtime calls it when closing
+    self._dialer.stop()
+    self._downloader.stop()
+    if self._unban_timer is not None:
+      self._unban_timer.cancel()
+      self._unban_timer = None
+    if self._bans_changed:
+      self._save_bans()
+    self.save_addresses()
+    self._shutdown_offload()
+    if self._log is not None: self._log.close()  # flush queued records
+  
+  def invalid_command(self, peer, payload, exception):
+    self.log('invalid command: %r (%s)',payload,exception)
+  
+  def connected(self, peer):    # called by a peer once know version
+    self._check_external_ip()
+  
+  def disconnected(self, peer): # called by a peer after closed
+    self._downloader.peer_closed(peer)
+    if not peer.incoming:
+      self._dialer.done(peer.address)
+      if not peer.verack:  # dial or handshake failed
+        self._addresses.failed(peer.address)
+      else: self._addresses.rate(peer.address,peer.quality)
+  
+  def congested(self, peer):    # called by a peer when its send queue over high water mark
+    self.log('send queue congested (%d bytes)',peer.send_queued,peer=peer,level=self.LOG_LEVEL_DEBUG)
+  
+  def drained(self, peer):      # called by a congested peer when its send queue under low water mark
+    self.log('send queue drained',peer=peer,level=self.LOG_LEVEL_DEBUG)
+  
+  def add_peer(self, address, force=True):  # if already have max_peers and not force, ignore adding
+    if not force and len(self._registry) >= self._max_peers:
+      return False  # too much peers
+    if address in self._registry:
+      return False  # already exists this peer
+    if self._bans.is_banned(address[0]):
+      return False
+    
+    self._addresses.attempt(address)
+    try:            # the runtime keeps a reference of the connection
+      self._connect(address)
+    except Exception as e:
+      self.log('meet error: %s',e,level=self.LOG_LEVEL_ERROR)
+      self._addresses.failed(address)
+      return False
+    return True
+  
+  def remove_peer(self, address):
+    peer = self._registry.get(address)
+    if peer is not None:
+      peer.handle_close()
+  
+  registry = property(lambda s: s._registry)
+  addresses = property(lambda s: s._addresses)  # addrman.AddressManager
+  downloader = property(lambda s: s._downloader)
+  
+  def save_addresses(self):
+    try:
+      self._addresses.save(self._addresses_path)
+    except (IOError, OSError) as e:
+      self.log('can not save addresses: %s',e,level=self.LOG_LEVEL_ERROR)
+    self._addresses_saved = time.time()
+  
+  @property
+  def peers(self):  # a list copy, use registry for lookup
+    return self._registry.peers()
+  
+  def broadcast(self, message, peers=None):  # the message is encoded once and shared by all send buffers
+    if peers is None: peers = self.peers
+    for peer in peers:
+      peer.send_message(message)
+  
+  def relay_inventory(self, inventory, source=None):
+    '''Announces inventory vectors to every handshaked peer except source
+       (the peer we got them from), skipping the ones a peer already knows
+       by its known inventory filter. Blocks are sent at once, others are
+       queued in each peer and trickled, see Peer.queue_inventory(). A
+       peer whose version said relay=False gets blocks only.
+       Returns the number of vectors sent or queued.'''
+    
+    blocks = [iv for iv in inventory if iv.object_type == protocol.OBJECT_TYPE_MSG_BLOCK]
+    if blocks:
+      inventory = [iv for iv in inventory if iv.object_type != protocol.OBJECT_TYPE_MSG_BLOCK]
+    
+    count = 0
+    for peer in self._registry.peers():
+      if peer is source or not peer.verack: continue
+      items = [iv for iv in blocks if not peer.knows_inventory(iv.hash)]
+      if items:
+        peer.add_known_inventory(iv.hash for iv in items)
+        for i in range(0,len(items),MAX_INVENTORY):
+          peer.send_message(protocol.Inventory.from_trusted(items[i:i + MAX_INVENTORY]))
+        count += len(items)
+      
+      if not peer.relay: continue  # it asked not to be told of transactions
+      items = [iv for iv in inventory if not peer.knows_inventory(iv.hash)]
+      if items:
+        peer.add_known_inventory(iv.hash for iv in items)
+        peer.queue_inventory(items)
+        count += len(items)
+    return count
+  
+  #----------------
+  
+  def punish_peer(self, peer, reason=None):
+    peer.add_banscore()
+    if peer.banscore > 5:
+      try:
+        self.ban(peer.ip)   # also closes it
+      except ValueError as e:  # dialed by host name
+        peer.handle_close()
+  
+  def ban(self, subnet, seconds=BAN_SECONDS):
+    '''Bans an ip or subnet (such as '10.1.0.0/16') for seconds and closes
+       its connected peers. Raises ValueError if subnet is invalid.'''
+    
+    self._bans.ban(subnet,time.time() + seconds)
+    self._bans_changed = True
+    self._schedule_unban()
+    for peer in self._registry.peers():
+      if self._bans.is_banned(peer.ip):
+        peer.handle_close()
+  
+  def unban(self, subnet):  # returns False if not banned
+    if not self._bans.unban(subnet):
+      return False
+    self._bans_changed = True
+    self._schedule_unban()
+    return True
+  
+  def is_banned(self, ip):
+    return self._bans.is_banned(ip)
+  
+  bans = property(lambda s: s._bans.bans())  # list of (subnet,until)
+  
+  def _schedule_unban(self):  # one timer for the earliest expiry
+    until = self._bans.next_expiry()
+    if self._unban_timer is not None:
+      if until == self._unban_at: return
+      self._unban_timer.cancel()
+      self._unban_timer = None
+    if until is not None:
+      self._unban_timer = self.call_later(max(0,until - time.time()),self._on_unban_timer)
+    self._unban_at = until
+  
+  def _on_unban_timer(self):
+    self._unban_timer = None
+    if self._bans.expire():
+      self._bans_changed = True
+    self._schedule_unban()
+  
+  def _save_bans(self):
+    self._bans_changed = False
+    try:
+      self._bans.save(self._bans_path)
+    except (IOError, OSError) as e:
+      self.log('can not save bans: %s',e,level=self.LOG_LEVEL_ERROR)
+  
+  def _check_external_ip(self):  # We rely on the peers to tell our IP, take the majority answer even if exists dishonest peer
+    counter = dict()
+    peers = self.peers
+    for peer in peers:
+      address = peer.external_ip
+      if address is None: continue
+      if address not in counter: counter[address] = 0
+      counter[address] += 1
+    if counter:
+      counter = [(counter[a],a) for a in counter]
+      counter.sort()
+      self._guessed_external_ip = counter[-1][1]
+  
+  def add_any_peer(self):  # dial one of known addresses or dns seeds, returns False if none to dial
+    return self._dialer.dial_any()
+  
+  def set_relay_limit(self, command, rate, burst=None):
+    '''Throttle command (such as 'inv') from each peer to rate bytes per
+       second, with bursts up to burst bytes. Messages over the limit are
+       dropped before parsing and counted in metrics, a dropped getdata is
+       not answered either. A rate of None removes the limit.'''
+    
+    key = protocol.Message.MessageTypes[command]._command_key
+    if rate is None:
+      self._relay_limits.pop(key,None)
+    else: self._relay_limits[key] = (command,rate,burst or rate)
+    for peer in self._registry.peers():  # take the new limit with full buckets
+      peer._buckets.pop(command,None)
+  
+  def heartbeat(self):     # called every 10 seconds to do maintenance
+    peers = self.peers
+    
+    # if need more peer connections, keep the dialer filling its slots
+    if len(peers) < self._seek_peers:
+      self._dialer.start()
+    
+    # if not many addresses, try ask more
+    if peers and len(self._addresses) < 50:
+      peer = random.choice(peers)
+      peer.send_message(protocol.GetAddress.from_trusted())
+    
+    for peer in peers:    # give a little back to peers that went bad but seem be OK now
+      peer.reduce_banscore()
+    
+    if time.time() - self._addresses_saved >= ADDRESSES_SAVE_INTERVAL:
+      self.save_addresses()
+    if self._unban_timer is None:
+      self._schedule_unban()
+    if self._bans_changed:
+      self._save_bans()
+  
+  def offload(self, command, prepare=None, executor=None):
+    '''Parse messages of command (such as 'block') in a worker pool instead
+       of the event loop, then call prepare(message) there too if given, its
+       result is passed to command_xxx as keyword argument prepared. Other
+       messages from the same peer wait, so the order is kept per peer.
+       
+       The default executor is a shared thread pool. Pass a process pool
+       for pure python work holding the GIL, then prepare must be picklable,
+       that is a function defined at module level.'''
+    
+    msg_type = protocol.Message.MessageTypes[command]
+    if executor is None:
+      if self._offload_executor is None:
+        if futures is None:
+          raise RuntimeError('concurrent.futures is required for offloading')
+        self._offload_executor = futures.ThreadPoolExecutor(OFFLOAD_WORKERS)
+      executor = self._offload_executor
+    self._offload[msg_type._command_key] = (command,prepare,executor)
+  
+  def _shutdown_offload(self):
+    self._offload.clear()
+    if self._offload_executor is not None:
+      self._offload_executor.shutdown(False)
+      self._offload_executor = None
+  
+  def enable_profiling(self, enabled=True):  # time the read, parse, handle and send stages of peers
+    if not enabled:
+      self._profiler = None
+    elif self._profiler is None:
+      self._profiler = profiling.Profiler()
+  
+  def profile_report(self, reset=False):
+    profiler = self._profiler
+    if profiler is None: return 'profiling is disabled'
+    report = profiler.report()
+    if reset: profiler.reset()
+    return report
+  
+  def sample_cprofile(self, seconds, sort='cumulative', limit=40, path=None):
+    '''Runs cProfile in the event loop for seconds, without restarting the
+       node, returns a profiling.Sample, call its wait() for the report.'''
+    return profiling.sample_cprofile(self,seconds,sort,limit,path)
+  
+  def sample_allocations(self, seconds, limit=20):
+    '''Traces allocations for seconds, returns a profiling.Sample.'''
+    return profiling.sample_allocations(self,seconds,limit)
+  
+  #----------------
+  
+  def _connect(self, address):  # create an outgoing connection, implemented by runtime
+    raise NotImplementedError()
+  
+  def call_later(self, delay, callback, *args):  # returns a handle with cancel(), implemented by runtime
+    raise NotImplementedError()
+  
+  def call_soon_threadsafe(self, callback, *args):  # run callback in event loop, can be called from other thread
+    raise NotImplementedError()
+  
+  def _add_reader(self, fd, callback):  # call back when fd readable, implemented by runtime
+    raise NotImplementedError()
+  
+  def _remove_reader(self, fd):
+    raise NotImplementedError()
+  
+  def _attach_cluster(self):  # runtime calls it when starting its event loop
+    if self._cluster is not None:
+      self._add_reader(self._cluster.fileno(),self._cluster.receive)
+  
+  def _merge_addresses(self, addresses, source=None):  # list of ((address,port),(timestamp,services)), returns new ones
+    merged = []
+    for (address, value) in addresses:
+      if self._addresses.add(address,value[0],value[1],source):
+        merged.append((address,value))
+    return merged
+  
+  def _accept_incoming(self, address):  # check an incoming connection before creating its peer
+    self.log('incoming connection from %r',address)
+    
+    if self._bans.is_banned(address[0]):
+      return False  # in a banned subnet
+    
+    if not self._listen: # if not accepting incoming, drop it
+      return False
+    
+    if len(self._registry) >= self._max_peers:  # make room by the worst inbound peer
+      peer = self._eviction_candidate()
+      if peer is None: return False
+      self.log('evict for new incoming (quality %.3f)',peer.quality,peer=peer,level=self.LOG_LEVEL_DEBUG)
+      peer.handle_close()
+    return True
+  
+  def _eviction_candidate(self):  # inbound peer of the lowest quality, None if all are too new
+    now = time.time()
+    peers = [p for p in self._registry.inbound_peers() if now - p.connected_time >= EVICT_MIN_SECONDS]
+    if not peers: return None
+    return min(peers,key=lambda p: p.quality)
+  
+  def _on_heartbeat(self):   # runtime calls it once when starting, then it is a timer
+    self._heartbeat_timer = self.call_later(HEARTBEAT_INTERVAL,self._on_heartbeat)
+    self.heartbeat()
+  
+  def begin_loop(self):   # hand the start of event loop, will override in sub-class
+    pass
+  
+  #------ command_xxx ----
+  
+  def command_ping(self, peer, nonce):
+    peer.send_message(protocol.Pong.from_trusted(nonce))
+  
+  def command_pong(self, peer, nonce):
+    pass
+  
+  def command_not_found(self, peer, inventory):  # ask other peers for them
+    self._downloader.not_found(peer,inventory)
+  
+  def command_version(self, peer, version, services, timestamp, addr_recv, addr_from, nonce, user_agent, start_height, relay):
+    peer.send_message(protocol.VersionAck.from_trusted())
+  
+  def command_version_ack(self, peer): # a peer acknowledged us, record address
+    if peer.incoming: return             # its port is not the listening one
+    merged = self._merge_addresses([(peer.address,(time.time(),peer.services))])
+    self._addresses.good(peer.address,peer.services)
+    self._dialer.done(peer.address)
+    if merged and self._cluster:
+      self._cluster.share_addresses(merged)
+    if len(self._addresses) < ADDRESSES_PER_ASK:  # a fresh node learns more without waiting heartbeat
+      peer.send_message(protocol.GetAddress.from_trusted())
+  
+  def command_get_address(self, peer):
+    changes = self._addresses.recent_changes
+    if self._address_message is None or self._address_message[0] != changes:
+      addresses = [protocol.NetworkAddress.from_trusted(timestamp,services,ip,port)
+                   for ((ip, port), timestamp, services) in self._addresses.recent(ADDRESSES_PER_ASK)]
+      self._address_message = (self._addresses.recent_changes,protocol.Address.from_trusted(addresses))
+    
+    # the same message until the recent addresses change, so it is encoded once for all askers
+    peer.send_message(self._address_message[1]) # send our address list to peer
+  
+  def command_address(self, peer, addr_list):
+    merged = self._merge_addresses([((a.address,a.port),(a.timestamp,a.services)) for a in addr_list],peer.ip)
+    if merged and self._cluster:  # other workers learn them without asking their peers
+      self._cluster.share_addresses(merged)
+
+def startServer(node):  # run node.serve_forever() in a daemon thread
+  ts = Thread(target=node.serve_forever)
+  ts.setDaemon(True)
+  ts.start()
+  time.sleep(2.5)  # waiting server thread started that will prepare upnp NAT
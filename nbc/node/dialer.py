@@ -0,0 +1,88 @@
+import random
+
+from .addrman import network_group
+
+__all__ = ['Dialer']
+
+MAX_DIALS = 8           # outgoing connections handshaking at the same time
+DIAL_TIMEOUT = 15       # seconds from dialing to verack before giving up
+DIAL_INTERVAL = 1       # seconds between filling free dial slots while short of peers
+SEED_CHANCE = 200       # use a dns seed for 1 of that many dials, even having addresses
+
+class Dialer(object):
+  '''Keeps up to MAX_DIALS outgoing connections in progress until node has
+     seek_peers peers, each one is closed if not handshaked in DIAL_TIMEOUT.
+     A finished dial frees its slot at once, so a fresh node fills up in
+     seconds instead of a few peers per heartbeat.
+     
+     Candidates come from node.addresses, which keeps the backoff and the
+     chance of each address, and addresses in the network group of an
+     outgoing peer are avoided while there are others.'''
+  
+  def __init__(self, node, max_dials=MAX_DIALS, timeout=DIAL_TIMEOUT):
+    self._node = node
+    self._max_dials = max_dials
+    self._timeout = timeout
+    self._dials = dict()  # map of address to its timeout timer
+    self._timer = None
+  
+  pending = property(lambda s: len(s._dials))
+  
+  def _wanted(self):
+    node = self._node
+    return min(self._max_dials - len(self._dials),node.seek_peers - len(node.registry))
+  
+  def start(self):  # fill the slots soon, then keep filling them every DIAL_INTERVAL while short of peers
+    if self._timer is not None:
+      self._timer.cancel()
+    self._timer = self._node.call_later(0,self._on_timer)
+  
+  def stop(self):
+    for timer in self._dials.values():
+      timer.cancel()
+    self._dials.clear()
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+  
+  def _on_timer(self):
+    self._timer = None
+    self.fill()
+    if self._node.seek_peers > len(self._node.registry):
+      self._timer = self._node.call_later(DIAL_INTERVAL,self._on_timer)
+  
+  def fill(self):   # dial candidates for the free slots
+    for i in range(self._wanted()):
+      if not self.dial_any(): break
+  
+  def dial_any(self):  # returns True if started to dial one
+    node = self._node
+    addresses = node.addresses
+    seeds = node.bootstrap
+    if seeds and (not addresses or random.randint(1,SEED_CHANCE) == 1):
+      return self.dial(random.choice(seeds),False)  # connection of RAW would be more using than normal
+    
+    registry = node.registry
+    groups = set(network_group(p.ip) for p in registry.outbound_peers())
+    address = addresses.select(registry,groups=groups)
+    if address is None and groups:  # all in known groups, still better than no peer
+      address = addresses.select(registry)
+    if address is None: return False
+    return self.dial(address)
+  
+  def dial(self, address, force=True):
+    if address in self._dials: return False
+    if not self._node.add_peer(address,force): return False
+    self._dials[address] = self._node.call_later(self._timeout,lambda: self._timed_out(address))
+    return True
+  
+  def _timed_out(self, address):
+    if self._dials.pop(address,None) is None: return
+    self._node.log('dial timeout %s:%d',address[0],address[1],level=self._node.LOG_LEVEL_DEBUG)
+    self._node.remove_peer(address)  # disconnected() counts it as a failure
+  
+  def done(self, address):  # handshaked or closed, node calls it for every outgoing peer
+    timer = self._dials.pop(address,None)
+    if timer is None: return
+    timer.cancel()
+    self.start()    # the slot is free now
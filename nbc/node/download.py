@@ -0,0 +1,272 @@
+import time
+from collections import OrderedDict
+
+from .. import protocol
+from .peer import MAX_INVENTORY
+
+__all__ = ['Downloader']
+
+# requests waiting on one peer, by object type
+MAX_IN_FLIGHT = { protocol.OBJECT_TYPE_MSG_TX: 100,
+                  protocol.OBJECT_TYPE_MSG_BLOCK: 16 }
+
+# seconds to wait a peer answering a request before asking another one
+REQUEST_TIMEOUT = { protocol.OBJECT_TYPE_MSG_TX: 30,
+                    protocol.OBJECT_TYPE_MSG_BLOCK: 120 }
+
+MAX_ANNOUNCED = 5000    # requests one peer can have announced and not yet answered, more are ignored
+CHECK_INTERVAL = 1      # seconds between checking timeouts while requests in flight
+LATENCY_WEIGHT = 0.25   # weight of a new response time in a peer's average
+DEFAULT_LATENCY = 1.0   # seconds assumed of a peer not measured yet, nor its ping
+
+class _Request(object):
+  __slots__ = ('vector', 'anywhere', 'candidates', 'tried', 'peer', 'sent', 'deadline')
+  
+  def __init__(self, vector):
+    self.vector = vector
+    self.anywhere = False     # wanted from any peer, not only the announcing ones
+    self.candidates = set()   # peers announced it
+    self.tried = set()        # peers failed to send it
+    self.peer = None          # the peer asked, None while pending
+    self.sent = 0
+    self.deadline = 0
+
+class _PeerState(object):
+  __slots__ = ('requests', 'counts', 'announced', 'latency')
+  
+  def __init__(self):
+    self.requests = dict()    # map of hash to _Request in flight
+    self.counts = dict()      # map of object type to requests in flight
+    self.announced = 0        # requests having the peer among candidates
+    self.latency = None       # average seconds of answering a request
+
+class Downloader(object):
+  '''Fetches announced transactions and blocks with getdata, each object
+     from one peer at a time. A request goes to the announcing peer with a
+     free slot (MAX_IN_FLIGHT) and the lowest response time (its ping round
+     trip time until a response is measured) divided by its Peer.quality,
+     so banscore, dropped messages and late pongs count too. Many objects
+     are fetched from all peers in parallel this way. A request not
+     answered in REQUEST_TIMEOUT, reported notfound or lost with a closed
+     peer is asked from another announcing peer, and dropped when none is
+     left until someone announces it again. Only a request wanted without
+     a peer is asked from any peer.
+     
+     Sub-class of node calls want() from command_inventory and received()
+     when a transaction or block arrives, NodeCore does the rest.'''
+  
+  def __init__(self, node):
+    self._node = node
+    self._requests = dict()         # map of hash to _Request
+    self._pending = OrderedDict()   # requests not in flight, in announced order
+    self._peers = dict()            # map of peer to _PeerState
+    self._flush_timer = None
+    self._check_timer = None
+  
+  pending = property(lambda s: len(s._pending))
+  in_flight = property(lambda s: len(s._requests) - len(s._pending))
+  
+  def __contains__(self, hash):
+    return hash in self._requests
+  
+  def latency(self, peer):  # average response time of peer, None if not measured
+    state = self._peers.get(peer)
+    return None if state is None else state.latency
+  
+  def in_flight_of(self, peer):
+    state = self._peers.get(peer)
+    return 0 if state is None else len(state.requests)
+  
+  def want(self, inventory, peer=None):
+    '''Requests inventory vectors announced by peer, or from any peer if
+       None. Returns the number of the ones not requested before. A peer
+       having MAX_ANNOUNCED requests unanswered is flooding, its further
+       announcements are ignored.'''
+    
+    state = None if peer is None else self._state(peer)
+    added = 0
+    for iv in inventory:
+      request = self._requests.get(iv.hash)
+      if state is not None and state.announced >= MAX_ANNOUNCED:
+        if request is None or peer not in request.candidates: continue
+      if request is None:
+        if iv.object_type not in MAX_IN_FLIGHT: continue
+        request = self._requests[iv.hash] = _Request(iv)
+        self._pending[iv.hash] = request
+        added += 1
+      if peer is None:
+        request.anywhere = True
+      elif peer not in request.candidates:
+        request.candidates.add(peer)
+        state.announced += 1
+    if self._pending:
+      self._schedule_flush()
+    return added
+  
+  def received(self, peer, hash):  # returns False if it was not requested
+    request = self._requests.pop(hash,None)
+    if request is None: return False
+    self._pending.pop(hash,None)
+    self._forget(request)
+    
+    asked = request.peer
+    if asked is not None:
+      state = self._release(asked,request)
+      if asked is peer and state is not None:
+        self._measure(state,time.time() - request.sent)
+    if self._pending:
+      self._schedule_flush()
+    return True
+  
+  def not_found(self, peer, inventory):  # peer does not have them, ask others
+    for iv in inventory:
+      request = self._requests.get(iv.hash)
+      if request is None or request.peer is not peer: continue
+      self._release(peer,request)
+      request.tried.add(peer)
+      self._retry(request)
+    if self._pending:
+      self._schedule_flush()
+  
+  def peer_closed(self, peer):
+    self._peers.pop(peer,None)
+    for request in list(self._requests.values()):
+      request.candidates.discard(peer)
+      request.tried.discard(peer)
+      if request.peer is peer:
+        request.peer = None
+        self._retry(request)
+      elif request.peer is None and not self._askable(request):
+        self._drop(request)
+    if self._pending:
+      self._schedule_flush()
+  
+  def stop(self):
+    for timer in (self._flush_timer, self._check_timer):
+      if timer: timer.cancel()
+    self._flush_timer = self._check_timer = None
+  
+  def _askable(self, request):  # any peer left to ask it
+    return request.anywhere or not request.candidates <= request.tried
+  
+  def _retry(self, request):  # pending again, or dropped if no announcing peer is left
+    if self._askable(request):
+      self._pending[request.vector.hash] = request
+    else: self._drop(request)
+  
+  def _drop(self, request):
+    h = request.vector.hash
+    self._pending.pop(h,None)
+    if self._requests.pop(h,None) is not None:
+      self._forget(request)
+  
+  def _forget(self, request):  # request is gone, it no longer counts for its announcers
+    for peer in request.candidates:
+      state = self._peers.get(peer)
+      if state is not None: state.announced -= 1
+  
+  def _state(self, peer):
+    state = self._peers.get(peer)
+    if state is None:
+      state = self._peers[peer] = _PeerState()
+    return state
+  
+  def _release(self, peer, request):  # request is answered or given up by peer, returns its state
+    request.peer = None
+    state = self._peers.get(peer)
+    if state is not None and state.requests.pop(request.vector.hash,None) is not None:
+      state.counts[request.vector.object_type] -= 1
+    return state
+  
+  def _measure(self, state, seconds):
+    if state.latency is None:
+      state.latency = seconds
+    else: state.latency += (seconds - state.latency) * LATENCY_WEIGHT
+  
+  def _schedule_flush(self):  # wants of one loop iteration go in one getdata per peer
+    if self._flush_timer is None:
+      self._flush_timer = self._node.call_later(0,self._flush)
+  
+  def _choose(self, request, peers):  # the fastest and best usable peer with a free slot, False if none usable at all
+    object_type = request.vector.object_type
+    limit = MAX_IN_FLIGHT[object_type]
+    usable = False
+    best = None
+    for peer in (peers if request.anywhere else request.candidates):
+      if peer in request.tried or not peer.verack: continue
+      usable = True
+      state = self._peers.get(peer)
+      if state is not None and state.counts.get(object_type,0) >= limit: continue
+      if state is not None and state.latency is not None:
+        latency = state.latency
+      elif peer.rtt is not None:
+        latency = peer.rtt
+      else: latency = DEFAULT_LATENCY
+      key = (latency / peer.quality,0 if state is None else len(state.requests))
+      if best is None or key < best[0]:
+        best = (key,peer)
+    if best is None:
+      return usable
+    return best[1]
+  
+  def _free_slots(self, peers):  # map of object type to free slots of all peers
+    free = dict((t,0) for t in MAX_IN_FLIGHT)
+    for peer in set(peers).union(self._peers):  # announcers have a state
+      if not peer.verack: continue
+      state = self._peers.get(peer)
+      for (object_type, limit) in MAX_IN_FLIGHT.items():
+        used = 0 if state is None else state.counts.get(object_type,0)
+        free[object_type] += max(0,limit - used)
+    return free
+  
+  def _flush(self):
+    self._flush_timer = None
+    now = time.time()
+    peers = self._node.peers
+    free = self._free_slots(peers)  # stop scanning once all peers are full, not walk all pending
+    batches = dict()  # map of peer to vectors to get
+    for (h, request) in list(self._pending.items()):
+      object_type = request.vector.object_type
+      if not free[object_type]:
+        if not any(free.values()): break
+        continue
+      
+      peer = self._choose(request,peers)
+      if peer is False:   # nobody left to ask
+        self._drop(request)
+        continue
+      if peer is True:    # all busy, wait for a free slot
+        continue
+      
+      del self._pending[h]
+      free[object_type] -= 1
+      request.peer = peer
+      request.sent = now
+      request.deadline = now + REQUEST_TIMEOUT[object_type]
+      state = self._state(peer)
+      state.requests[h] = request
+      state.counts[object_type] = state.counts.get(object_type,0) + 1
+      batches.setdefault(peer,[]).append(request.vector)
+    
+    for (peer, vectors) in batches.items():
+      for i in range(0,len(vectors),MAX_INVENTORY):
+        peer.send_message(protocol.GetData.from_trusted(vectors[i:i + MAX_INVENTORY]))
+    
+    if self.in_flight and self._check_timer is None:
+      self._check_timer = self._node.call_later(CHECK_INTERVAL,self._on_check)
+  
+  def _on_check(self):
+    self._check_timer = None
+    now = time.time()
+    for (peer, state) in list(self._peers.items()):
+      for request in list(state.requests.values()):
+        if request.deadline > now: continue
+        self._release(peer,request)
+        self._measure(state,now - request.sent)  # a slow peer falls behind the others
+        request.tried.add(peer)
+        self._retry(request)
+    
+    if self._pending:
+      self._schedule_flush()  # not _flush(), a flush may be scheduled already
+    elif self.in_flight:
+      self._check_timer = self._node.call_later(CHECK_INTERVAL,self._on_check)
@@ -0,0 +1,63 @@
+import logging
+
+try:
+  from logging.handlers import QueueHandler, QueueListener
+  from queue import Queue
+except ImportError:  # python2, records are written in the calling thread
+  QueueHandler = QueueListener = None
+
+__all__ = ['PROTOCOL', 'Debug', 'StreamLogger']
+
+PROTOCOL = 5  # below logging.DEBUG, every message sent and received
+logging.addLevelName(PROTOCOL,'PROTOCOL')
+
+class Debug(object):
+  'Log argument of a message, its _debug() walks the message only when formatted'
+  
+  __slots__ = ('message',)
+  
+  def __init__(self, message):
+    self.message = message
+  
+  def __str__(self):
+    return self.message._debug()
+
+if QueueHandler is not None:
+  class _DeferredHandler(QueueHandler):
+    def prepare(self, record):  # keep msg and args as is, listener thread formats them
+      return record
+
+class StreamLogger(object):
+  '''A logger writing to stream (such as sys.stdout) from a listener thread,
+     logging a record only puts it in a queue, the message and arguments
+     are formatted later in that thread. Arguments should not be changed
+     after logged, messages are immutable so they are fine.'''
+  
+  def __init__(self, stream, name='nbc.node'):
+    self._stream = stream
+    self._logger = logging.Logger(name)  # not registered, so gone with its node
+    self._handler = None
+    self._listener = None
+    
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter('%(message)s'))
+    if QueueHandler is None:
+      self._handler = target
+    else:
+      queue = Queue()
+      self._handler = _DeferredHandler(queue)
+      self._listener = QueueListener(queue,target)
+      self._listener.start()
+    self._logger.addHandler(self._handler)
+  
+  logger = property(lambda s: s._logger)
+  
+  def close(self):  # flush the queued records, later ones are written directly
+    if self._listener is None: return
+    self._listener.stop()
+    self._listener = None
+    
+    self._logger.removeHandler(self._handler)
+    self._handler = logging.StreamHandler(self._stream)
+    self._handler.setFormatter(logging.Formatter('%(message)s'))
+    self._logger.addHandler(self._handler)
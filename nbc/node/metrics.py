@@ -0,0 +1,230 @@
+import bisect
+import os
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+__all__ = ['Histogram', 'Metrics', 'Snapshot', 'render', 'serve', 'snapshot']
+
+# upper bounds (seconds) of the latency histograms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+RENDER_TIMEOUT = 5   # seconds the HTTP thread waits for the event loop
+INVALID = 'invalid'  # command of the payloads failed to parse, garbage should not add labels
+
+class Histogram(object):
+  __slots__ = ('counts', 'sum', 'count')
+  
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+    self.sum = 0.0
+    self.count = 0
+  
+  def observe(self, value):
+    self.counts[bisect.bisect_left(BUCKETS,value)] += 1
+    self.sum += value
+    self.count += 1
+
+class CommandStats(object):
+  __slots__ = ('rx_messages', 'rx_bytes', 'tx_messages', 'tx_bytes', 'dropped_messages', 'dropped_bytes', 'parse', 'handle')
+  
+  def __init__(self):
+    self.rx_messages = self.rx_bytes = 0
+    self.tx_messages = self.tx_bytes = 0
+    self.dropped_messages = self.dropped_bytes = 0  # over the relay limits, not parsed
+    self.parse = Histogram()   # seconds parsing (with checksum) a received message
+    self.handle = Histogram()  # seconds in command_xxx
+
+class Metrics(object):
+  '''Counters and latency histograms per command, updated by peers in the
+     event loop. Per peer counters are kept on the peer itself, render()
+     puts both together.'''
+  
+  def __init__(self):
+    self._commands = dict()  # map of command to CommandStats
+    self._started = time.time()
+  
+  commands = property(lambda s: s._commands)
+  started = property(lambda s: s._started)
+  
+  def _stats(self, command):
+    stats = self._commands.get(command)
+    if stats is None:
+      stats = self._commands[command] = CommandStats()
+    return stats
+  
+  def received(self, command, size, parse_seconds, handle_seconds=None):
+    stats = self._stats(command)
+    stats.rx_messages += 1
+    stats.rx_bytes += size
+    stats.parse.observe(parse_seconds)
+    if handle_seconds is not None:
+      stats.handle.observe(handle_seconds)
+  
+  def sent(self, command, size):
+    stats = self._stats(command)
+    stats.tx_messages += 1
+    stats.tx_bytes += size
+  
+  def dropped(self, command, size):
+    stats = self._stats(command)
+    stats.dropped_messages += 1
+    stats.dropped_bytes += size
+
+# Prometheus text format
+
+def _label(value):
+  return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _histogram(lines, name, labels, histogram):
+  total = 0
+  for (bound, count) in zip(BUCKETS + ('+Inf',),histogram.counts):
+    total += count
+    lines.append('%s_bucket{%s,le="%s"} %d' % (name,labels,bound,total))
+  lines.append('%s_sum{%s} %.6f' % (name,labels,histogram.sum))
+  lines.append('%s_count{%s} %d' % (name,labels,histogram.count))
+
+def render(node):
+  '''Returns the metrics of node in Prometheus text format, should be called
+     in the event loop of node.'''
+  
+  lines = []
+  def header(name, kind, text):
+    lines.append('# HELP %s %s' % (name,text))
+    lines.append('# TYPE %s %s' % (name,kind))
+  
+  header('nbc_uptime_seconds','gauge','Seconds since the node created.')
+  lines.append('nbc_uptime_seconds %.3f' % (time.time() - node.metrics.started))
+  header('nbc_rx_bytes_total','counter','Bytes received from all peers.')
+  lines.append('nbc_rx_bytes_total %d' % node._rx_bytes)
+  header('nbc_tx_bytes_total','counter','Bytes sent to all peers.')
+  lines.append('nbc_tx_bytes_total %d' % node._tx_bytes)
+  
+  commands = sorted(node.metrics.commands.items())
+  for (name, attr, text) in ( ('nbc_command_rx_messages_total','rx_messages','Messages received by command.'),
+                              ('nbc_command_rx_bytes_total','rx_bytes','Bytes received by command.'),
+                              ('nbc_command_tx_messages_total','tx_messages','Messages sent by command.'),
+                              ('nbc_command_tx_bytes_total','tx_bytes','Bytes sent by command.'),
+                              ('nbc_command_dropped_messages_total','dropped_messages','Messages dropped by relay limits by command.'),
+                              ('nbc_command_dropped_bytes_total','dropped_bytes','Bytes dropped by relay limits by command.') ):
+    header(name,'counter',text)
+    for (command, stats) in commands:
+      lines.append('%s{command="%s"} %d' % (name,_label(command),getattr(stats,attr)))
+  
+  for (name, attr, text) in ( ('nbc_command_parse_seconds','parse','Seconds parsing a received message.'),
+                              ('nbc_command_handle_seconds','handle','Seconds in command_xxx handler.') ):
+    header(name,'histogram',text)
+    for (command, stats) in commands:
+      _histogram(lines,name,'command="%s"' % _label(command),getattr(stats,attr))
+  
+  peers = [('%s:%d' % (p.ip,p.port),p) for p in node.peers]
+  header('nbc_peers','gauge','Connected peers.')
+  lines.append('nbc_peers %d' % len(peers))
+  for (name, kind, value, text) in (
+      ('nbc_peer_rx_messages_total','counter',lambda p: p.rx_messages,'Messages received from peer.'),
+      ('nbc_peer_tx_messages_total','counter',lambda p: p.tx_messages,'Messages sent to peer.'),
+      ('nbc_peer_rx_bytes_total','counter',lambda p: p.rx_bytes,'Bytes received from peer.'),
+      ('nbc_peer_tx_bytes_total','counter',lambda p: p.tx_bytes,'Bytes sent to peer.'),
+      ('nbc_peer_parse_seconds_total','counter',lambda p: p.parse_seconds,'Seconds parsing messages of peer.'),
+      ('nbc_peer_handle_seconds_total','counter',lambda p: p.handle_seconds,'Seconds in command_xxx for peer.'),
+      ('nbc_peer_dropped_messages_total','counter',lambda p: p.dropped,'Messages of peer dropped by relay limits.'),
+      ('nbc_peer_send_queue_bytes','gauge',lambda p: p.send_queued,'Bytes waiting to be sent to peer.'),
+      ('nbc_peer_pipelined_messages','gauge',lambda p: p.pipelined,'Received messages waiting for the worker pool.'),
+      ('nbc_peer_rtt_seconds','gauge',lambda p: 'NaN' if p.rtt is None else '%.6f' % p.rtt,'Average ping round trip time of peer.'),
+      ('nbc_peer_throughput_bytes','gauge',lambda p: '%.1f' % p.throughput,'Average bytes per second to and from peer.'),
+      ('nbc_peer_quality','gauge',lambda p: '%.4f' % p.quality,'Quality score of peer, higher is better.') ):
+    header(name,kind,text)
+    for (label, peer) in peers:
+      lines.append('%s{peer="%s"} %s' % (name,_label(label),value(peer)))
+  
+  lines.append('')
+  return '\n'.join(lines)
+
+def _render_in_loop(node):  # from other thread, None if the event loop does not answer in time
+  done = threading.Event()
+  result = []
+  def run():
+    try:
+      result.append(render(node))
+    finally:
+      done.set()
+  node.call_soon_threadsafe(run)
+  done.wait(RENDER_TIMEOUT)
+  return result[0] if result else None
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    
+    text = _render_in_loop(self.server.node)
+    if text is None:
+      self.send_error(503,'event loop is busy')
+      return
+    
+    body = text.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length',str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  
+  def log_message(self, format, *args):  # keep scraping quiet
+    pass
+
+def serve(node, address=('127.0.0.1',9333)):
+  '''Serves GET /metrics for node in a daemon thread, returns the server,
+     call its shutdown() to stop. Bind to localhost unless behind firewall.'''
+  
+  server = BaseHTTPServer.HTTPServer(address,_Handler)
+  server.node = node
+  thread = threading.Thread(target=server.serve_forever,name='nbc-metrics')
+  thread.daemon = True
+  thread.start()
+  return server
+
+class Snapshot(object):
+  '''Writes the metrics of node to path every interval seconds, the file is
+     replaced atomically so readers never see a partial one.'''
+  
+  def __init__(self, node, path, interval=60):
+    self._node = node
+    self._path = path
+    self._interval = interval
+    self._timer = node.call_later(interval,self._write)
+  
+  def _write(self):
+    node = self._node
+    try:
+      directory = os.path.dirname(self._path)
+      (fd, temp) = tempfile.mkstemp(prefix=os.path.basename(self._path) + '.',suffix='.tmp',dir=directory or '.')
+      try:
+        with os.fdopen(fd,'w') as f:
+          f.write(render(node))
+        if hasattr(os,'replace'):
+          os.replace(temp,self._path)
+        else: os.rename(temp,self._path)  # python2, atomic on posix
+      except Exception as e:
+        os.remove(temp)
+        raise
+    except Exception as e:  # keep trying, a full disk may be fixed later
+      node.log('can not write metrics snapshot: %s',e,level=node.LOG_LEVEL_ERROR)
+    finally:
+      self._timer = node.call_later(self._interval,self._write)
+  
+  def cancel(self):
+    if self._timer: self._timer.cancel()
+    self._timer = None
+
+def snapshot(node, path, interval=60):
+  '''Starts writing snapshot file of node, returns the Snapshot. Call it in
+     the event loop, or before serve_forever() of BaseNode.'''
+  return Snapshot(node,path,interval)
+
+# from nbc.node import basenode, metrics
+# node = basenode.BaseNode(address=('127.0.0.1',30303))
+# metrics.serve(node)            # curl http://127.0.0.1:9333/metrics
+# metrics.snapshot(node,'metrics.prom')
@@ -0,0 +1,542 @@
+import os
+import random
+import time
+import traceback
+from collections import deque
+
+from .. import protocol
+from .bloom import RollingBloomFilter
+from .logs import Debug
+from .metrics import INVALID
+from .throttle import TokenBucket
+
+BLOCK_SIZE = 8192             # initial receive block size, adapts per connection
+MIN_BLOCK_SIZE = 4096         # for peers sending small messages
+MAX_BLOCK_SIZE = 1048576      # for peers sending large blocks
+RECV_KEEP_SIZE = 262144       # drop larger receive buffer once it is drained
+
+SEND_HIGH_WATER = 4194304     # queued bytes that make a peer congested
+SEND_LOW_WATER  = 1048576     # congested peer is drained below it
+
+MAX_PIPELINED = 32            # messages waiting behind offloaded ones before stop reading
+
+KNOWN_INVENTORY = 50000       # inventory hashes remembered as known by each peer
+KNOWN_INVENTORY_FP = 0.00001  # chance of skipping an announcement the peer does not know
+
+MAX_INVENTORY = 50000         # vectors in one inv message
+TRICKLE_INBOUND = 5.0         # mean seconds between flushing queued announcements to an inbound peer
+TRICKLE_OUTBOUND = 2.0        # to an outbound peer, ours are relayed faster through the peers we chose
+
+_INVENTORY_COMMANDS = frozenset(('inv', 'getdata', 'notfound'))
+
+PING_INTERVAL = 120           # seconds between pings measuring round trip time
+PING_TIMEOUT = 1200           # seconds waiting a pong before closing the peer
+RTT_WEIGHT = 0.2              # weight of a new round trip time in the average
+RTT_HISTORY = 16              # recent round trip times kept
+THROUGHPUT_WEIGHT = 0.3       # weight of the last ping interval in the average bytes per second
+
+QUALITY_RTT = 0.5             # seconds of round trip time halving the quality, also assumed before measured
+QUALITY_THROUGHPUT = 10240    # bytes per second of a fully busy peer
+
+_SECONDS_OF_180M = 180 * 60   # 180 Minutes * 60
+
+_timer = getattr(time,'perf_counter',time.time)
+
+def _parse_offloaded(payload, magic, prepare):  # runs in the worker pool
+  t0 = _timer()
+  message = protocol.Message.parse(payload,magic)
+  parse_seconds = _timer() - t0
+  return (message, None if prepare is None else prepare(message), parse_seconds)
+
+class Peer(object):
+  '''Transport independent part of a connection to remote node: framing of
+     received data into messages, calling node's command_xxx, and the state
+     of remote node. Sub-class does the socket I/O, it should receive into
+     _recv_buffer and call _received(), and implement _write(data) and
+     handle_close().
+     
+     Commands set by node.offload() are parsed in a worker pool, messages
+     after them wait in _jobs, so command_xxx of one peer are still called
+     in the order received.'''
+  
+  SERVICES = protocol.SERVICE_NODE_NETWORK
+  
+  def __init__(self, node, address, incoming):
+    self._node = node
+    self._congested = False
+    self._backlogged = False
+    self._jobs = deque()  # (payload,future,prepare) in arrival order, future is None for an inline one
+    self._recv_buffer = bytearray(BLOCK_SIZE)  # receive buffer, unhandled data is [_recv_start:_recv_end]
+    self._recv_start = 0
+    self._recv_end = 0
+    self._block_size = BLOCK_SIZE
+    self._recv_stats = dict(reads=0,full_reads=0,grows=0,shrinks=0)
+    self._tx_bytes = 0
+    self._rx_bytes = 0
+    self._tx_messages = 0
+    self._rx_messages = 0
+    self._parse_seconds = 0.0   # time in parsing and handling messages of this peer
+    self._handle_seconds = 0.0
+    self._buckets = dict()      # map of command to TokenBucket, see node.set_relay_limit()
+    self._dropped = 0           # messages dropped by the relay limits
+    self._known_inventory = None  # RollingBloomFilter of hashes the peer has or was told, created on use
+    self._inventory_queue = []  # vectors to announce when the trickle timer fires
+    self._trickle_timer = None
+    
+    self._last_tx_time = 0
+    self._last_ping_time = 0
+    self._ping_nonce = None     # nonce of the ping waiting its pong
+    self._ping_sent = 0         # _timer() when that ping was sent
+    self._rtt = None            # average round trip seconds
+    self._min_rtt = None
+    self._rtt_history = deque(maxlen=RTT_HISTORY)
+    self._throughput = 0.0      # average bytes per second, both directions
+    self._throughput_mark = (0,0)  # (time,bytes) of the last sampling
+    self._last_rx_time = 0
+    self._start_time = 0
+    self._ping_timer = None
+    self._idle_timer = None
+    
+    # remote node details
+    self._address = address
+    self._incoming = incoming
+    self._external_ip = None
+    self._services = None
+    self._start_height = None
+    self._user_agent = None
+    self._version = None
+    self._relay = None
+    
+    self._banscore = 0
+    self._verack = False # get version acknowledgement or not
+  
+  def _send_version(self):  # bootstrap communication with the node by broadcasting ver
+    node = self._node
+    address = self._address
+    now = time.time()
+    message = protocol.Version( version = node.coin.protocol_version,
+                services = self.SERVICES,
+                timestamp = now,
+                addr_recv = protocol.NetworkAddress(now,self.SERVICES,address[0],address[1]),
+                addr_from = protocol.NetworkAddress(now,self.SERVICES,node.external_ip,node.port),
+                nonce = os.urandom(8),
+                user_agent = node.user_agent,
+                start_height = node.blockchain_height,
+                relay = False )
+    self.send_message(message)
+  
+  # remote node details
+  address = property(lambda s: s._address)
+  ip = property(lambda s: s._address[0])
+  port = property(lambda s: s._address[1])
+  
+  incoming = property(lambda s: s._incoming)
+  
+  services = property(lambda s: s._services)
+  start_height = property(lambda s: s._start_height)
+  user_agent = property(lambda s: s._user_agent)
+  version = property(lambda s: s._version)
+  relay = property(lambda s: s._relay)
+  external_ip = property(lambda s: s._external_ip)
+  
+  # connection details
+  verack = property(lambda s: s._verack)
+  congested = property(lambda s: s._congested)  # too much queued data, peer is not reading
+  block_size = property(lambda s: s._block_size)
+  rx_bytes = property(lambda s: s._rx_bytes)
+  tx_bytes = property(lambda s: s._tx_bytes)
+  rx_messages = property(lambda s: s._rx_messages)
+  tx_messages = property(lambda s: s._tx_messages)
+  parse_seconds = property(lambda s: s._parse_seconds)
+  handle_seconds = property(lambda s: s._handle_seconds)
+  pipelined = property(lambda s: len(s._jobs))  # received messages waiting for the worker pool
+  dropped = property(lambda s: s._dropped)
+  
+  node = property(lambda s: s._node)
+  banscore = property(lambda s: s._banscore)
+  
+  # round trip time measured by ping and pong, None until the first pong
+  rtt = property(lambda s: s._rtt)
+  min_rtt = property(lambda s: s._min_rtt)
+  rtt_history = property(lambda s: list(s._rtt_history))
+  throughput = property(lambda s: s._throughput)
+  ping_pending = property(lambda s: s._ping_nonce is not None)
+  
+  @property
+  def quality(self):
+    '''Score in (0,1], higher is better. The average round trip time halves
+       it at each QUALITY_RTT, and it grows with throughput up to
+       QUALITY_THROUGHPUT. Banscore, messages dropped by the relay limits
+       and a ping not answered in PING_INTERVAL lower it. Used to pick
+       download peers, rate addresses and evict inbound peers.'''
+    
+    rtt = QUALITY_RTT if self._rtt is None else self._rtt
+    score = QUALITY_RTT / (QUALITY_RTT + rtt)
+    score *= 0.5 + 0.5 * min(1.0,self._throughput / QUALITY_THROUGHPUT)
+    score *= 0.8 ** min(self._banscore,20)
+    if self._dropped:
+      score *= 0.5
+    if self._ping_nonce is not None and time.time() - self._last_ping_time > PING_INTERVAL:
+      score *= 0.5
+    return score
+  
+  @property
+  def recv_stats(self):  # shows how the adaptive receive block size is working
+    stats = dict(self._recv_stats)
+    stats['block_size'] = self._block_size
+    stats['bytes_per_read'] = self._rx_bytes / stats['reads'] if stats['reads'] else 0
+    return stats
+  
+  connected_time = property(lambda s: s._start_time)  # 0 while dialing
+  
+  # last time we heard from remote
+  timestamp = property(lambda s: (time.time() - s._last_rx_time))
+  
+  def knows_inventory(self, hash):
+    return self._known_inventory is not None and hash in self._known_inventory
+  
+  def add_known_inventory(self, hashes):  # the peer announced, asked for or sent them, or we announced them
+    known = self._known_inventory
+    if known is None:
+      known = self._known_inventory = RollingBloomFilter(KNOWN_INVENTORY,KNOWN_INVENTORY_FP)
+    for h in hashes:
+      known.add(h)
+  
+  def queue_inventory(self, inventory):
+    '''Announces inventory vectors after a random delay (exponential, mean
+       TRICKLE_OUTBOUND or TRICKLE_INBOUND seconds), together with the ones
+       queued meanwhile, so many small inv messages become a few large ones
+       and the timing tells less about where a transaction came from.'''
+    
+    self._inventory_queue.extend(inventory)
+    if self._trickle_timer is None:
+      mean = TRICKLE_INBOUND if self._incoming else TRICKLE_OUTBOUND
+      self._trickle_timer = self.node.call_later(random.expovariate(1.0 / mean),self._flush_inventory)
+  
+  def _flush_inventory(self):
+    self._trickle_timer = None
+    queue = self._inventory_queue
+    self._inventory_queue = []
+    for i in range(0,len(queue),MAX_INVENTORY):
+      self.send_message(protocol.Inventory.from_trusted(queue[i:i + MAX_INVENTORY]))
+  
+  inventory_queued = property(lambda s: len(s._inventory_queue))
+  
+  def add_banscore(self, penalty=1):
+    self._banscore += penalty
+  
+  def reduce_banscore(self, penalty=1):
+    i = self._banscore - penalty
+    self._banscore = 0 if i < 0 else i
+  
+  def _start_timers(self):  # ping and idle deadlines scheduled by node, instead of polling
+    self._start_time = time.time()
+    self._throughput_mark = (self._start_time,self._rx_bytes + self._tx_bytes)
+    self._ping_timer = self.node.call_later(PING_INTERVAL,self._on_ping_timer)
+    self._idle_timer = self.node.call_later(_SECONDS_OF_180M,self._on_idle_timer)
+  
+  def _cancel_timers(self):
+    for timer in (self._ping_timer, self._idle_timer, self._trickle_timer):
+      if timer: timer.cancel()
+    self._ping_timer = self._idle_timer = self._trickle_timer = None
+    self._inventory_queue = []
+  
+  def _on_ping_timer(self):
+    # ping every PING_INTERVAL, a peer not answering in PING_TIMEOUT is gone
+    now = time.time()
+    self._sample_throughput(now)
+    if self._ping_nonce is not None and now - self._last_ping_time >= PING_TIMEOUT:
+      self._ping_timer = None
+      self.node.log('ping timeout',peer=self,level=self.node.LOG_LEVEL_INFO)
+      self.handle_close()
+      return
+    
+    self.send_ping()
+    self._ping_timer = self.node.call_later(PING_INTERVAL,self._on_ping_timer)
+  
+  def send_ping(self):  # one ping at a time, its pong updates rtt
+    if self._ping_nonce is not None: return
+    nonce = os.urandom(8)
+    self.send_message(protocol.Ping.from_trusted(nonce))
+    self._ping_nonce = nonce
+    self._ping_sent = _timer()
+    self._last_ping_time = time.time()
+  
+  def _received_pong(self, nonce):
+    if nonce != self._ping_nonce: return  # not ours, or unsolicited
+    rtt = _timer() - self._ping_sent
+    self._ping_nonce = None
+    
+    self._rtt_history.append(rtt)
+    if self._rtt is None:
+      self._rtt = rtt
+    else: self._rtt += (rtt - self._rtt) * RTT_WEIGHT
+    if self._min_rtt is None or rtt < self._min_rtt:
+      self._min_rtt = rtt
+  
+  def _sample_throughput(self, now):
+    (then, total) = self._throughput_mark
+    current = self._rx_bytes + self._tx_bytes
+    if now > then:
+      rate = (current - total) / (now - then)
+      self._throughput += (rate - self._throughput) * THROUGHPUT_WEIGHT
+    self._throughput_mark = (now,current)
+  
+  def _on_idle_timer(self):
+    # it's been over 3 hours since last heard from remote, just disconnect
+    now = time.time()
+    due = (self._last_rx_time or self._start_time) + _SECONDS_OF_180M
+    if now >= due:
+      self._idle_timer = None
+      self.handle_close()
+    else: self._idle_timer = self.node.call_later(due - now,self._on_idle_timer)
+  
+  def _set_congested(self, congested):  # backpressure from send side, tell the node
+    if congested == self._congested: return
+    self._congested = congested
+    self._update_reading()
+    if congested:
+      self.node.congested(self)
+    else: self.node.drained(self)
+  
+  def _set_backlogged(self, backlogged):  # too many messages waiting for the worker pool
+    if backlogged == self._backlogged: return
+    self._backlogged = backlogged
+    self._update_reading()
+  
+  def _update_reading(self):  # runtime stops reading while congested or backlogged
+    pass
+  
+  def _reserve_recv(self, size):  # make sure size bytes room after _recv_end
+    buf = self._recv_buffer
+    if len(buf) - self._recv_end >= size: return
+    
+    if self._recv_start:  # compact only when running out of room
+      del buf[:self._recv_start]
+      self._recv_end -= self._recv_start
+      self._recv_start = 0
+    
+    free = len(buf) - self._recv_end
+    if free < size:
+      buf.extend(b'\x00' * (size - free))
+  
+  def _adapt_block_size(self, got):
+    size = self._block_size
+    stats = self._recv_stats
+    stats['reads'] += 1
+    
+    # grow toward the declared length of the partial message
+    length = protocol.Message.first_msg_len(self._recv_buffer,self._recv_start,self._recv_end)
+    need = 0 if length is None else length - (self._recv_end - self._recv_start)
+    if got >= size:
+      stats['full_reads'] += 1
+    if need > size:
+      size = min(need,MAX_BLOCK_SIZE)
+    elif got >= size:               # more data may be waiting
+      size = min(size * 2,MAX_BLOCK_SIZE)
+    elif need <= 0 and got < size // 4:  # chatty peer with small messages
+      size = max(size // 2,MIN_BLOCK_SIZE)
+    
+    if size > self._block_size:
+      stats['grows'] += 1
+    elif size < self._block_size:
+      stats['shrinks'] += 1
+    self._block_size = size
+  
+  def _received(self, got):  # got bytes just received at _recv_end
+    self._recv_end += got
+    self._rx_bytes += got
+    self.node._rx_bytes += got
+    self._last_rx_time = time.time()
+    
+    # process as many messages, consume them by moving _recv_start
+    buf = self._recv_buffer
+    while True:
+      start = self._recv_start
+      length = protocol.Message.first_msg_len(buf,start,self._recv_end)
+      if length is None or start + length > self._recv_end:
+        break  # not enough bytes for next message
+      
+      # copy out one message (parsed objects keep slices of it) and handle it
+      payload = memoryview(buf)[start:start + length].tobytes()
+      self._recv_start = start + length
+      self._dispatch(payload)
+    
+    if self._recv_start == self._recv_end:  # all consumed, rewind without copying
+      self._recv_start = self._recv_end = 0
+      if len(buf) > RECV_KEEP_SIZE:
+        self._recv_buffer = bytearray(BLOCK_SIZE)
+    
+    self._adapt_block_size(got)
+  
+  def _dispatch(self, payload):
+    node = self.node
+    limit = node._relay_limits.get(payload[4:16])
+    if limit is not None and self._throttled(limit,len(payload)):
+      return  # a dropped getdata is not answered, the requester times out and asks others
+    
+    offload = node._offload.get(payload[4:16]) if node._offload else None
+    if offload is None:
+      if not self._jobs:
+        self._handle_payload(payload)
+        return
+      self._jobs.append((payload,None,None))  # keep order, wait for the offloaded ones before it
+    else:
+      (command, prepare, executor) = offload
+      future = executor.submit(_parse_offloaded,payload,node.coin.magic,prepare)
+      self._jobs.append((payload,future,prepare))
+      future.add_done_callback(self._job_done)
+    
+    if len(self._jobs) >= MAX_PIPELINED:
+      self._set_backlogged(True)
+  
+  def _throttled(self, limit, size):  # returns True if over the limit, then the message is dropped
+    (command, rate, burst) = limit
+    now = _timer()
+    bucket = self._buckets.get(command)
+    if bucket is None:
+      bucket = self._buckets[command] = TokenBucket(rate,burst,now)
+    if bucket.take(size,now):
+      return False
+    
+    self._dropped += 1
+    self.node.metrics.dropped(command,size)
+    return True
+  
+  def _job_done(self, future):  # called in worker thread, result is handled in event loop
+    self.node.call_soon_threadsafe(self._run_jobs)
+  
+  def _run_jobs(self):
+    jobs = self._jobs
+    while jobs:
+      (payload, future, prepare) = jobs[0]
+      if future is not None and not future.done(): break
+      jobs.popleft()
+      
+      if future is None:
+        self._handle_payload(payload)
+        continue
+      try:
+        (message, prepared, parse_seconds) = future.result()
+      except (protocol.UnknownMsgError, protocol.MsgFormatError) as e:
+        self._count_received(INVALID,len(payload),0.0)
+        self.node.invalid_command(self,payload,e)
+        continue
+      except Exception as e:  # just print error, avoid stopping
+        self.node.log(traceback.format_exc(),peer=self,level=self.node.LOG_LEVEL_ERROR)
+        continue
+      
+      if prepare is None:
+        self._handle_parsed(message,len(payload),parse_seconds)
+      else: self._handle_parsed(message,len(payload),parse_seconds,prepared=prepared)
+    
+    if len(jobs) < MAX_PIPELINED:
+      self._set_backlogged(False)
+  
+  def _cancel_jobs(self):
+    for (payload, future, prepare) in self._jobs:
+      if future is not None: future.cancel()
+    self._jobs.clear()
+  
+  def _handle_payload(self, payload):
+    profiler = self.node._profiler
+    if profiler is not None: started = profiler.start()
+    t0 = _timer()
+    try:
+      message = protocol.Message.parse(payload,self.node.coin.magic)
+      if profiler is not None:
+        profiler.stop('parse',started,message.command)
+    except (protocol.UnknownMsgError, protocol.MsgFormatError) as e:
+      self._count_received(INVALID,len(payload),_timer() - t0)
+      self.node.invalid_command(self,payload,e)
+      return
+    except Exception as e:  # just print error, avoid stopping
+      self.node.log(traceback.format_exc(),peer=self,level=self.node.LOG_LEVEL_ERROR)
+      return
+    
+    self._handle_parsed(message,len(payload),_timer() - t0)
+  
+  def _handle_parsed(self, message, size, parse_seconds, **extra):
+    profiler = self.node._profiler
+    if profiler is not None: started = profiler.start()
+    t0 = _timer()
+    try:
+      self.handle_message(message,**extra)
+    except Exception as e:  # just print error, avoid stopping
+      self.node.log(traceback.format_exc(),peer=self,level=self.node.LOG_LEVEL_ERROR)
+    if profiler is not None:
+      profiler.stop('handle',started,message.command)
+    self._count_received(message.command,size,parse_seconds,_timer() - t0)
+  
+  def _count_received(self, command, size, parse_seconds, handle_seconds=None):
+    self._rx_messages += 1
+    self._parse_seconds += parse_seconds
+    if handle_seconds is not None:
+      self._handle_seconds += handle_seconds
+    self.node.metrics.received(command,size,parse_seconds,handle_seconds)
+  
+  def _write(self, data):
+    raise NotImplementedError()
+  
+  def handle_close(self):
+    raise NotImplementedError()
+  
+  def handle_message(self, message, **extra):  # extra is prepared result of an offloaded command
+    logLevel = self.node.log_level
+    if logLevel <= self.node.LOG_LEVEL_PROTOCOL:
+      self.node.log('<<< %s', message, peer=self, level=logLevel)
+    elif logLevel <= self.node.LOG_LEVEL_DEBUG:
+      self.node.log('<<< %s', Debug(message), peer=self, level=logLevel)
+    
+    kwargs = dict((k,getattr(message,k)) for (k,t) in message.properties)
+    if extra: kwargs.update(extra)
+    if message.command == protocol.Version.command:
+      self._services = message.services
+      self._start_height = message.start_height
+      self._user_agent = message.user_agent
+      self._version = message.version
+      self._relay = message.relay
+      self._external_ip = message.addr_recv.address
+      
+      self.node.connected(self)
+    elif message.command == protocol.VersionAck.command:
+      self._verack = True
+      self.send_ping()    # know the round trip time early
+    elif message.command == protocol.Pong.command:
+      self._received_pong(message.nonce)
+    elif message.command in _INVENTORY_COMMANDS:
+      self.add_known_inventory(iv.hash for iv in message.inventory)
+    
+    if message:
+      method = getattr(self.node,'command_'+message.name,None)
+      if method:
+        method(self,**kwargs)
+      else:
+        self.node.log('error: method not defined: command_%s', message.name, peer=self, level=self.node.log_level)
+  
+  def send_message(self, message):
+    logLevel = self.node.log_level
+    if logLevel <= self.node.LOG_LEVEL_PROTOCOL:
+      self.node.log('>>> %s', message, peer=self, level=logLevel)
+    elif logLevel <= self.node.LOG_LEVEL_DEBUG:
+      self.node.log('>>> %s', Debug(message), peer=self, level=logLevel)
+    
+    profiler = self.node._profiler
+    if profiler is not None: started = profiler.start()
+    
+    data = message.binary(self.node.coin.magic)
+    self._tx_messages += 1
+    self.node.metrics.sent(message.command,len(data))
+    self._write(data)
+    
+    if profiler is not None:
+      profiler.stop('send',started,message.command)
+  
+  def __hash__(self):
+    return hash(self.address)
+  
+  def __eq__(self, other):
+    return self is other
+  
+  def __str__(self):
+    return '<%s %s:%d>' % (self.__class__.__name__,self.ip,self.port)
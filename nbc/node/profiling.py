@@ -0,0 +1,156 @@
+import cProfile
+import pstats
+import sys
+import threading
+import time
+
+try:
+  from StringIO import StringIO
+except ImportError:  # python3
+  from io import StringIO
+
+try:
+  import tracemalloc
+except ImportError:  # python2
+  tracemalloc = None
+
+__all__ = ['Profiler', 'Sample', 'sample_cprofile', 'sample_allocations']
+
+_wall = getattr(time,'perf_counter',time.time)
+_cpu = getattr(time,'thread_time',None) or getattr(time,'process_time',None) or time.clock  # event loop thread only if possible
+_blocks = getattr(sys,'getallocatedblocks',None)  # CPython 3.4+
+
+class Profiler(object):
+  '''Wall time, CPU time and net allocated memory blocks of the hot path
+     stages: read (whole receiving, the other stages nested in it), parse,
+     handle (command_xxx) and send (encoding and queuing). A stage is keyed
+     by (stage,command), command is None for read.
+     
+     Peers only check node.profiler is None when it is disabled.'''
+  
+  def __init__(self):
+    self._stats = dict()  # map of (stage,command) to [count,wall,cpu,blocks]
+    self._since = time.time()
+  
+  def start(self):
+    return (_wall(), _cpu(), _blocks() if _blocks else 0)
+  
+  def stop(self, stage, started, command=None):
+    (wall, cpu, blocks) = started
+    wall = _wall() - wall
+    cpu = _cpu() - cpu
+    blocks = (_blocks() - blocks) if _blocks else 0
+    
+    stats = self._stats.get((stage,command))
+    if stats is None:
+      self._stats[(stage,command)] = [1,wall,cpu,blocks]
+    else:
+      stats[0] += 1
+      stats[1] += wall
+      stats[2] += cpu
+      stats[3] += blocks
+  
+  def reset(self):
+    self._stats = dict()
+    self._since = time.time()
+  
+  def stats(self):  # list of (stage,command,count,wall,cpu,blocks), most wall time first
+    items = [k + tuple(v) for (k,v) in dict(self._stats).items()]
+    items.sort(key=lambda i: -i[3])
+    return items
+  
+  def report(self):
+    lines = [ 'profiled %.1f seconds, time in milliseconds, blocks are net allocated ones' % (time.time() - self._since),
+              '%-7s %-12s %9s %11s %11s %9s %9s %9s' % ('stage','command','count','wall','cpu','wall/msg','cpu/msg','blocks') ]
+    for (stage, command, count, wall, cpu, blocks) in self.stats():
+      lines.append('%-7s %-12s %9d %11.2f %11.2f %9.4f %9.4f %9s' % (stage, command or '-', count,
+          wall * 1000, cpu * 1000, wall * 1000 / count, cpu * 1000 / count, blocks if _blocks else '-'))
+    return '\n'.join(lines)
+
+class Sample(object):
+  'Result of an on-demand sampling, finished in the event loop of node'
+  
+  def __init__(self):
+    self._done = threading.Event()
+    self.report = None
+  
+  done = property(lambda s: s._done.is_set())
+  
+  def wait(self, timeout=None):  # returns the report, None if not finished yet
+    self._done.wait(timeout)
+    return self.report
+  
+  def _finish(self, report):
+    self.report = report
+    self._done.set()
+
+def _sampling(node, kind, sample, begin, end):  # runs begin() in the event loop, end() after seconds
+  def start(seconds):
+    if kind in node._sampling:
+      sample._finish('error: another %s sampling is running' % kind)
+      return
+    try:
+      state = begin()
+    except Exception as e:
+      sample._finish('error: %s' % e)
+      return
+    node._sampling.add(kind)
+    def stop():
+      node._sampling.discard(kind)
+      try:
+        sample._finish(end(state))
+      except Exception as e:
+        sample._finish('error: %s' % e)
+    node.call_later(seconds,stop)
+  return start
+
+def sample_cprofile(node, seconds, sort='cumulative', limit=40, path=None):
+  '''Profiles the event loop thread of node with cProfile for seconds, can
+     be called from any thread. Returns a Sample, its report is the pstats
+     text, the raw stats are also dumped to path if given.'''
+  
+  sample = Sample()
+  def begin():
+    profile = cProfile.Profile()
+    profile.enable()  # only the calling thread, so it must be the event loop
+    return profile
+  def end(profile):
+    profile.disable()
+    if path: profile.dump_stats(path)
+    out = StringIO()
+    pstats.Stats(profile,stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+  
+  node.call_soon_threadsafe(_sampling(node,'cProfile',sample,begin,end),seconds)
+  return sample
+
+def sample_allocations(node, seconds, limit=20, frames=1):
+  '''Traces memory allocations of the process for seconds, returns a Sample
+     whose report lists the source lines allocating most during that time.'''
+  
+  sample = Sample()
+  if tracemalloc is None:
+    sample._finish('error: tracemalloc not available')
+    return sample
+  
+  def begin():
+    if tracemalloc.is_tracing():
+      raise RuntimeError('tracemalloc is already tracing')
+    tracemalloc.start(frames)
+    return tracemalloc.take_snapshot()
+  def end(before):
+    after = tracemalloc.take_snapshot()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lines = ['traced %d bytes, peak %d bytes' % (current,peak)]
+    for stat in after.compare_to(before,'lineno')[:limit]:
+      lines.append(str(stat))
+    return '\n'.join(lines)
+  
+  node.call_soon_threadsafe(_sampling(node,'tracemalloc',sample,begin,end),seconds)
+  return sample
+
+# from nbc.node import basenode
+# node.enable_profiling()
+# print(node.profile_report())
+# print(node.sample_cprofile(30).wait())
@@ -0,0 +1,63 @@
+__all__ = ['PeerRegistry']
+
+class PeerRegistry(object):
+  '''Connected peers indexed by address, ip, runtime key (fileno in the
+     asyncore map, id() of the connection for asyncio) and direction. The
+     runtime calls add() and remove() whenever it adds or removes a
+     connection, so every lookup is O(1) instead of scanning its map.'''
+  
+  def __init__(self):
+    self._by_key = dict()
+    self._by_address = dict()
+    self._by_ip = dict()     # map of ip to set of peers
+    self._inbound = set()
+    self._outbound = set()
+  
+  def add(self, key, peer):
+    if key in self._by_key:
+      self.remove(key)
+    self._by_key[key] = peer
+    self._by_address[peer.address] = peer
+    self._by_ip.setdefault(peer.ip,set()).add(peer)
+    (self._inbound if peer.incoming else self._outbound).add(peer)
+  
+  def remove(self, key):  # returns the removed peer, None if not registered
+    peer = self._by_key.pop(key,None)
+    if peer is None: return None
+    
+    if self._by_address.get(peer.address) is peer:
+      del self._by_address[peer.address]
+    same_ip = self._by_ip.get(peer.ip)
+    if same_ip is not None:
+      same_ip.discard(peer)
+      if not same_ip: del self._by_ip[peer.ip]
+    self._inbound.discard(peer)
+    self._outbound.discard(peer)
+    return peer
+  
+  def get(self, address, default=None):
+    return self._by_address.get(address,default)
+  
+  def by_key(self, key, default=None):
+    return self._by_key.get(key,default)
+  
+  def by_ip(self, ip):
+    return list(self._by_ip.get(ip,()))
+  
+  def peers(self):  # a copy, so peers can be closed while iterating
+    return list(self._by_key.values())
+  
+  def inbound_peers(self):
+    return list(self._inbound)
+  
+  def outbound_peers(self):
+    return list(self._outbound)
+  
+  inbound_count = property(lambda s: len(s._inbound))
+  outbound_count = property(lambda s: len(s._outbound))
+  
+  def __contains__(self, address):
+    return address in self._by_address
+  
+  def __len__(self):
+    return len(self._by_key)
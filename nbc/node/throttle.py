@@ -0,0 +1,33 @@
+__all__ = ['RELAY_LIMITS', 'TokenBucket']
+
+# (bytes per second, burst bytes) each peer may send of a relay command, a
+# burst takes at least one largest message; bytes rather than messages so
+# both the parsing and the bandwidth of a chatty peer are limited
+RELAY_LIMITS = {
+  'inv':     (32768, 1048576),   # 36 bytes per item, 50000 items at most in one message
+  'getdata': (65536, 2097152),
+  'tx':      (131072, 1048576),
+  'addr':    (300, 65536),       # about 10 addresses per second, 1000 in a burst
+}
+
+class TokenBucket(object):
+  'Tokens refill at rate per second up to burst, take() fails when not enough'
+  
+  __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+  
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.stamp = now
+  
+  def take(self, cost, now):
+    tokens = self.tokens + (now - self.stamp) * self.rate
+    if tokens > self.burst: tokens = self.burst
+    self.stamp = now
+    if cost > self.burst: cost = self.burst  # a single large message passes when full
+    if tokens < cost:
+      self.tokens = tokens
+      return False
+    self.tokens = tokens - cost
+    return True
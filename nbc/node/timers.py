@@ -0,0 +1,79 @@
+import heapq
+import itertools
+import time
+
+__all__ = ['Scheduler', 'Timer']
+
+_now = getattr(time,'monotonic',time.time)  # not affected by system clock changes
+
+class Timer(object):
+  __slots__ = ('when', 'callback', 'args', 'cancelled', '_owner')
+  
+  def __init__(self, when, callback, args, owner=None):
+    self.when = when
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+    self._owner = owner
+  
+  def cancel(self):
+    if not self.cancelled:
+      self.cancelled = True
+      self.callback = self.args = None  # release references early
+      if self._owner is not None:
+        self._owner._cancelled += 1
+        self._owner = None
+
+class Scheduler(object):
+  '''Heap of deadlines owned by a node. The event loop sleeps until the
+     nearest deadline, then only runs the expired timers, so each loop
+     iteration costs O(expired) instead of checking every peer. Cancelled
+     timers stay in the heap until popped or the heap is compacted.'''
+  
+  def __init__(self):
+    self._heap = []
+    self._seq = itertools.count()  # keep FIFO order for same deadline
+    self._cancelled = 0
+  
+  def __len__(self):
+    return len(self._heap) - self._cancelled
+  
+  def call_later(self, delay, callback, *args):
+    return self.call_at(_now() + delay,callback,*args)
+  
+  def call_at(self, when, callback, *args):
+    timer = Timer(when,callback,args,self)
+    heapq.heappush(self._heap,(when,next(self._seq),timer))
+    return timer
+  
+  def _discard_cancelled(self):
+    heap = self._heap
+    while heap and heap[0][2].cancelled:
+      heapq.heappop(heap)
+      self._cancelled -= 1
+    
+    # compact when most entries are cancelled ones
+    if self._cancelled > 64 and self._cancelled * 2 > len(heap):
+      heap[:] = [item for item in heap if not item[2].cancelled]
+      heapq.heapify(heap)
+      self._cancelled = 0
+  
+  def timeout(self, maximum):  # seconds until nearest deadline, at most maximum
+    self._discard_cancelled()
+    if not self._heap: return maximum
+    return min(max(self._heap[0][0] - _now(),0),maximum)
+  
+  def pop_expired(self, now=None):
+    '''Returns the timers whose deadline passed, in deadline order.'''
+    
+    if now is None: now = _now()
+    heap = self._heap
+    ret = []
+    while heap and heap[0][0] <= now:
+      timer = heapq.heappop(heap)[2]
+      if timer.cancelled:
+        self._cancelled -= 1
+      else:
+        timer._owner = None  # cancel() after expired changes nothing
+        ret.append(timer)
+    return ret
@@ -0,0 +1,271 @@
+'''Round-trip, fuzz and throughput harness for the wire format.
+
+Runs offline against generated messages:
+
+  python -m nbc.protocol.bench                  # default sizes
+  python -m nbc.protocol.bench --scale 10 --count 50 --fuzz 200
+  python -m nbc.protocol.bench --only tx,block --no-alloc
+
+Every run first checks parse(binary(x)) == x (and that re-encoding the
+parsed fields gives the same bytes), then fuzzes the parser with mutated
+payloads, then measures parse and serialize throughput. The exit code is 1
+when any check fails, so it can be used as a regression gate.'''
+
+import random
+import struct
+import sys
+import time
+
+try:
+  import tracemalloc
+except ImportError:  # python2
+  tracemalloc = None
+
+from . import format
+from . import messages
+from .messages import Message, MsgFormatError, UnknownMsgError, _checksum
+
+__all__ = ['KINDS', 'make_message', 'roundtrip', 'fuzz', 'benchmark', 'run']
+
+MAGIC = b'\xf9\x6e\x62\x63'
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# generators, scale is the relative size of the message (count of entries)
+
+def _hash(rng):
+  return bytes(bytearray(rng.getrandbits(8) for i in range(32)))
+
+def _bytes(rng, size):
+  return bytes(bytearray(rng.getrandbits(8) for i in range(size)))
+
+def _ip(rng):
+  if rng.random() < 0.8:
+    return '.'.join(str(rng.randint(1,254)) for i in range(4))
+  return ':'.join('%x' % rng.randint(1,0xffff) for i in range(8))
+
+def _network_address(rng, timestamp=None):
+  if timestamp is None:
+    timestamp = rng.randint(1500000000,1800000000)
+  return format.NetworkAddress(timestamp, rng.choice([0,1,3,1033]), _ip(rng), rng.randint(1,65535))
+
+def _txn_args(rng, inputs, outputs):
+  tx_in = [ format.TxnIn(format.OutPoint(_hash(rng),rng.randint(0,20)),
+                         _bytes(rng,rng.randint(70,110)), 0xffffffff)
+            for i in range(inputs) ]
+  tx_out = [ format.TxnOut(rng.randint(546,21000000 * 100000000), _bytes(rng,25))
+             for i in range(outputs) ]
+  return (1, tx_in, tx_out, rng.choice([0, rng.randint(1,500000)]))
+
+def make_version(rng, scale=1):
+  return messages.Version( version = 70002,
+             services = 1,
+             timestamp = rng.randint(1500000000,1800000000),
+             addr_recv = _network_address(rng,0),
+             addr_from = _network_address(rng,0),
+             nonce = _bytes(rng,8),
+             user_agent = b'/nbc:0.0.1(newbitcoin)/',
+             start_height = rng.randint(0,600000),
+             relay = 1 )
+
+def make_address(rng, scale=1):
+  return messages.Address([_network_address(rng) for i in range(min(10 * scale,1000))])
+
+def make_inventory(rng, scale=1):
+  return messages.Inventory([format.InventoryVector(rng.choice([1,2]),_hash(rng))
+                             for i in range(min(50 * scale,50000))])
+
+def make_headers(rng, scale=1):
+  return messages.Headers([ format.BlockHeader(1, _hash(rng), _hash(rng),
+                              rng.randint(1500000000,1800000000), 486604799,
+                              rng.getrandbits(32), 0 )
+                            for i in range(20 * scale) ])
+
+def make_transaction(rng, scale=1):
+  return messages.Transaction(*_txn_args(rng,rng.randint(1,2 * scale),rng.randint(1,2 * scale)))
+
+def make_block(rng, scale=1):
+  txns = [format.Txn(*_txn_args(rng,rng.randint(1,3),rng.randint(1,3))) for i in range(20 * scale)]
+  return messages.Block(1, _hash(rng), _hash(rng), rng.randint(1500000000,1800000000),
+                        486604799, rng.getrandbits(32), txns)
+
+KINDS = [ ('version',make_version), ('addr',make_address), ('inv',make_inventory),
+          ('headers',make_headers), ('tx',make_transaction), ('block',make_block) ]
+
+def make_message(kind, rng=None, scale=1):
+  if rng is None: rng = random.Random()
+  return dict(KINDS)[kind](rng, scale)
+
+# round trip checking
+
+def _same(a, b):
+  if isinstance(a, format.CompoundType):
+    if type(a) != type(b): return False
+    return all(_same(getattr(a,k),getattr(b,k)) for k in a._keys)
+  if isinstance(a, (list,tuple)):
+    if not isinstance(b,(list,tuple)) or len(a) != len(b): return False
+    return all(_same(x,y) for (x,y) in zip(a,b))
+  return a == b
+
+def _rebuild(obj):  # a copy without retained raw bytes, so binary() really encodes
+  if isinstance(obj, format.CompoundType):
+    return type(obj).from_trusted(*[_rebuild(getattr(obj,k)) for k in obj._keys])
+  if isinstance(obj, (list,tuple)):
+    return [_rebuild(o) for o in obj]
+  return obj
+
+def roundtrip(message, magic=MAGIC):
+  '''Returns None if parse(binary(x)) == x, otherwise a description.'''
+
+  data = message.binary(magic)
+  parsed = Message.parse(data, magic)
+  if not _same(message, parsed):
+    return 'parsed fields differ'
+  if parsed.binary(magic) != data:
+    return 'relayed bytes differ'
+  if _rebuild(parsed).binary(magic) != data:
+    return 're-encoded bytes differ'
+  return None
+
+def check_var_integer():
+  errors = []
+  for value in (0, 0xfc, 0xfd, 0xfe, 0xff, 0xffff, 0x10000, 0xffffffff, 0x100000000, 2 ** 64 - 1):
+    data = format.FtVarInteger.binary(value)
+    if format.FtVarInteger.parse(data) != (len(data),value):
+      errors.append('var_integer %d' % value)
+  return errors
+
+# fuzzing
+
+def _mutate(rng, payload):
+  payload = bytearray(payload)
+  choice = rng.randint(0,2)
+  if choice == 0 and payload:    # flip some bytes
+    for i in range(rng.randint(1,8)):
+      payload[rng.randrange(len(payload))] = rng.getrandbits(8)
+  elif choice == 1 and payload:  # truncate
+    del payload[rng.randrange(len(payload)):]
+  else:                          # append garbage
+    payload.extend(_bytes(rng,rng.randint(1,64)))
+  return bytes(payload)
+
+def fuzz(message, rounds, rng=None, magic=MAGIC):
+  '''Parse mutated payloads with a valid header, returns unexpected errors.'''
+
+  if rng is None: rng = random.Random()
+  data = message.binary(magic)
+  errors = []
+  for i in range(rounds):
+    payload = _mutate(rng, data[24:])
+    mutated = data[:16] + struct.pack('<I',len(payload)) + _checksum(payload) + payload
+    try:
+      parsed = Message.parse(mutated, magic)
+      _rebuild(parsed).binary(magic)
+    except (format.ParameterError, MsgFormatError, UnknownMsgError):
+      pass
+    except Exception as e:
+      errors.append('%s: %r' % (type(e).__name__,e))
+  return errors
+
+# throughput
+
+def _measure(func, count):
+  t0 = _timer()
+  for i in range(count):
+    func()
+  return _timer() - t0
+
+def _allocations(func, count):
+  '''Returns (allocated blocks, peak traced bytes) per call, the blocks
+     are the ones still held by the result of func when it returns.'''
+
+  if tracemalloc is None: return (None, None)
+  tracemalloc.start()
+  try:
+    before = tracemalloc.take_snapshot()
+    peak = 0
+    results = []  # keep them alive until the snapshot
+    for i in range(count):
+      if hasattr(tracemalloc,'reset_peak'):  # python3.9+
+        tracemalloc.reset_peak()
+      base = tracemalloc.get_traced_memory()[0]
+      results.append(func())
+      peak = max(peak,tracemalloc.get_traced_memory()[1] - base)
+    after = tracemalloc.take_snapshot()
+    del results
+  finally:
+    tracemalloc.stop()
+  blocks = sum(s.count_diff for s in after.compare_to(before,'lineno'))
+  return (blocks // count, peak)
+
+def benchmark(message, count, magic=MAGIC, alloc=True):
+  data = message.binary(magic)
+
+  def parse():
+    return Message.parse(data, magic)
+
+  fresh = _rebuild(message)
+  def serialize():
+    fresh._encodings = None  # drop the encoding cache, measure real work
+    return fresh.binary(magic)
+
+  result = dict(size=len(data), count=count)
+  for (name, func) in (('parse',parse), ('serialize',serialize)):
+    elapsed = _measure(func, count) or 1e-9
+    result[name + '_msgs'] = count / elapsed
+    result[name + '_mbs'] = len(data) * count / elapsed / 1e6
+    if alloc:
+      (blocks, peak) = _allocations(func, min(count,20))
+      result[name + '_blocks'] = blocks
+      result[name + '_peak'] = peak
+  return result
+
+def run(kinds=None, scale=1, count=100, fuzz_rounds=100, seed=0, alloc=True, out=sys.stdout):
+  '''Runs all checks and benchmarks, returns the number of failures.'''
+
+  rng = random.Random(seed)
+  failures = 0
+
+  for error in check_var_integer():
+    out.write('FAIL %s\n' % error)
+    failures += 1
+
+  out.write('%-8s %9s %11s %9s %11s %9s %8s %9s %8s %9s\n' % ('kind','bytes',
+    'parse/s','MB/s','serial/s','MB/s','p.blocks','p.peak','s.blocks','s.peak'))
+  for (kind, maker) in KINDS:
+    if kinds and kind not in kinds: continue
+    message = maker(rng, scale)
+
+    error = roundtrip(message)
+    if error:
+      out.write('FAIL %s round trip: %s\n' % (kind,error))
+      failures += 1
+    for error in fuzz(message, fuzz_rounds, rng):
+      out.write('FAIL %s fuzz: %s\n' % (kind,error))
+      failures += 1
+
+    r = benchmark(message, count, alloc=alloc)
+    out.write('%-8s %9d %11.1f %9.2f %11.1f %9.2f %8s %9s %8s %9s\n' % (kind, r['size'],
+      r['parse_msgs'], r['parse_mbs'], r['serialize_msgs'], r['serialize_mbs'],
+      r.get('parse_blocks','-'), r.get('parse_peak','-'),
+      r.get('serialize_blocks','-'), r.get('serialize_peak','-')))
+
+  return failures
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description='wire format round-trip, fuzz and benchmark')
+  parser.add_argument('--scale', type=int, default=1, help='relative message size')
+  parser.add_argument('--count', type=int, default=100, help='iterations per benchmark')
+  parser.add_argument('--fuzz', type=int, default=100, help='mutated payloads per kind')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--only', default='', help='comma separated kinds: %s' % ','.join(k for (k,m) in KINDS))
+  parser.add_argument('--no-alloc', action='store_true', help='skip allocation counting')
+  args = parser.parse_args(argv)
+
+  kinds = [k for k in args.only.split(',') if k]
+  failures = run(kinds, args.scale, args.count, args.fuzz, args.seed, not args.no_alloc)
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
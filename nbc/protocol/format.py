@@ -8,9 +8,15 @@ from .. import util
 _ZERO_STR10  = b'\x00' * 10
 _IP_HEAD_STR = _ZERO_STR10 + b'\xff\xff'
 
+# debug switch, when True from_trusted() runs the full validation as __init__ does
+VALIDATE_TRUSTED = False
+
 def ORD(ch):   # compatible to python3
   return ch if type(ch) == int else ord(ch)
 
+def BYTES(data):  # detach a memoryview slice from its parent buffer
+  return data if type(data) == bytes else data.tobytes()
+
 def parse_var_set(data, kind):
   '''Reads a set of parsable objects prefixed with a VarInteger.'''
   
@@ -47,6 +53,8 @@ class _AutoRegister(type):
       setattr(cls,key,getPara(key))
     
     cls._name = name
+    cls._keys = tuple(k for (k, vt) in cls.properties)  # cached for construction
+    cls._key_set = frozenset(cls._keys)
     
     for base in bases:
       if hasattr(base,'register'):
@@ -58,16 +66,15 @@ class _AutoRegister(type):
 class CompoundType(object):
   properties = []  # [(sName,type), ...]
   
+  _raw = None      # the original encoding (maybe a memoryview slice) of parsed object
+  
   def __init__(self, *args, **kw):
-    keys = [k for (k, t) in self.properties] # self.properties defines all args and kw
-    
-    # convert the positional arguments into kw
-    params = dict(zip(keys,args))
+    # convert the positional arguments into kw, self.properties defines all args and kw
+    params = dict(zip(self._keys,args))
+    keys = self._key_set
     for k in kw:
       if k in params:    # can not redefine
         raise TypeError('got multiple values for keyword argument %r' % k)
-    keys = set(keys)
-    for k in kw:
       if k not in keys:  # unknown keywords
         raise TypeError('got an unexpected keyword argument %r' % k)
     
@@ -86,7 +93,38 @@ class CompoundType(object):
     
     self._properties = params
   
+  @classmethod
+  def from_trusted(cls, *args, **kw):
+    '''Create from values the caller just parsed or computed, skipping the
+       validation done by __init__. Lists still become tuples, an instance
+       is immutable so its cached encodings stay valid. Set
+       VALIDATE_TRUSTED = True to validate them anyway when debugging.'''
+    
+    if VALIDATE_TRUSTED:
+      return cls(*args, **kw)
+    
+    params = dict(zip(cls._keys,args))
+    if kw: params.update(kw)
+    for (key, value) in params.items():
+      if isinstance(value,list):
+        params[key] = tuple(value)
+    self = cls.__new__(cls)
+    self._properties = params
+    return self
+  
+  def __getstate__(self):  # for a process pool, a memoryview can not be pickled
+    state = self.__dict__.copy()
+    state.pop('_raw',None)  # encoded again when needed
+    return state
+  
+  def _encoded(self):  # raw encoding if parsed, avoid copying
+    if self._raw is not None:
+      return self._raw
+    return b''.join(vt.binary(self._properties[key]) for (key,vt) in self.properties)
+  
   def binary(self):
+    if self._raw is not None:
+      return BYTES(self._raw)
     return b''.join(vt.binary(self._properties[key]) for (key,vt) in self.properties)
   
   @classmethod
@@ -103,6 +141,7 @@ class CompoundType(object):
     # create without __init__ (would unnecessarily verify the parameters)
     self = cls.__new__(cls)
     self._properties = kw
+    self._raw = data[:offset]  # keep wire bytes, binary() and hash will reuse it
     return (offset,self)
   
   def __str__(self):
@@ -235,9 +274,9 @@ class FtVarInteger(FormatType):
   def binary(obj):
     if obj < 0xfd:
       return struct.pack('<B',obj)
-    elif obj < 0xffff:
+    elif obj <= 0xffff:
       return b'\xfd' + struct.pack('<H',obj)
-    elif obj < 0xffffffff:
+    elif obj <= 0xffffffff:
       return b'\xfe' + struct.pack('<I',obj)
     return b'\xff' + struct.pack('<Q',obj)
 
@@ -248,7 +287,7 @@ class FtVarInteger(FormatType):
       return (3,struct.unpack('<H', data[1:3])[0])
     elif value == 0xfe:
       return (5,struct.unpack('<I', data[1:5])[0])
-    elif value == 0xfd:
+    elif value == 0xff:
       return (9,struct.unpack('<Q', data[1:9])[0])
     return (1,value)
   
@@ -311,6 +350,7 @@ class FtIPAddress(FormatType):
   
   @staticmethod
   def parse(data):
+    data = BYTES(data[:16])
     if data.startswith(_ZERO_STR10) and data[10:12] == (b'\xff\xff'): # ipv4
       return (16, '.'.join(str(i) for i in struct.unpack('>BBBB', data[12:16])))
     return (16, ':'.join(('%x' % i) for i in struct.unpack('>HHHHHHHH', data[:16])))
@@ -339,7 +379,7 @@ class FtBytes(FormatType):
     return obj
   
   def parse(self, data):
-    return (self._length, data[:self._length])
+    return (self._length, BYTES(data[:self._length]))
   
   def str(self, obj):
     return b'0x' + hexlify(obj)
@@ -363,11 +403,11 @@ class FtVarString(FormatType):
   
   @staticmethod
   def parse(data):
-    if type(data) == bytes:  # bytes == str in python2
+    if isinstance(data,(bytes,memoryview)):  # bytes == str in python2
       pass
     else: data = data.encode('latin-1') # for python3
     (vl,length) = FtVarInteger.parse(data)
-    obj = data[vl:vl+length]
+    obj = BYTES(data[vl:vl+length])
     return (vl + len(obj), obj)
   
   def str(self, obj):
@@ -419,7 +459,7 @@ class FtNetworkAddress(FtCompoundType):
 class FtNetworkAddressNoTimestamp(FtNetworkAddress):
   @classmethod
   def parse(cls, data):
-    (vl,obj) = FtNetworkAddress.parse(b'\x00\x00\x00\x00' + data) # timestamp will be 0
+    (vl,obj) = FtNetworkAddress.parse(b'\x00\x00\x00\x00' + BYTES(data[:26])) # timestamp will be 0
     return (vl - 4, obj)
   
   def binary(self, obj):
@@ -481,7 +521,7 @@ class Txn(CompoundType):
   @property
   def hash(self):
     if '__hash' not in self._properties:
-      self._properties['__hash'] = util.sha256d(self.binary())
+      self._properties['__hash'] = util.sha256d(self._encoded())
     return self._properties['__hash']
 
 class FtTxn(FtInventoryVector):
@@ -500,14 +540,14 @@ class BlockHeader(CompoundType):
   
   @staticmethod
   def from_block(block):
-    return BlockHeader( block.version, block.previous_hash,
+    return BlockHeader.from_trusted( block.version, block.previous_hash,
              block.merkle_root, block.timestamp,
              block.bits, block.nonce,len(block.transactions) )
   
   @property
   def hash(self):
     if '__hash' not in self._properties:
-      self._properties['__hash'] = util.sha256d(self.binary()[:80])
+      self._properties['__hash'] = util.sha256d(self._encoded()[:80])
     return self._properties['__hash']
 
 class FtBlockHeader(FtInventoryVector):
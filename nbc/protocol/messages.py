@@ -40,6 +40,19 @@ def _debug(obj, params):
   
   return ' '.join(message) + '>'
 
+_sha256 = hashlib.sha256()  # copy() a ready hasher, cheaper than creating new one
+
+def _checksum(payload):
+  h = _sha256.copy()
+  h.update(payload)
+  h2 = _sha256.copy()
+  h2.update(h.digest())
+  return h2.digest()[:4]
+
+def _command_key(command):
+  command = command.encode('latin-1')
+  return command + (b'\x00' * (12 - len(command)))  # pad to 12 bytes
+
 class UnknownMsgError(Exception): pass  # when command not registed
 class MsgFormatError(Exception): pass   # invalid message header
 
@@ -63,48 +76,79 @@ class Message(format.CompoundType):
   _magic = None  # only parsed messages will have a magic number
   magic = property(lambda s: s._magic)
   
+  _checksum = None  # verified checksum of the retained raw payload
+  _encodings = None # {magic: bytes}, encoded message cache of this instance
+  _command_key = None
+  
+  def __getstate__(self):
+    state = format.CompoundType.__getstate__(self)
+    state.pop('_encodings',None)
+    if self._raw is not None:  # one copy of the payload, so relaying still skips encoding
+      state['_raw'] = format.BYTES(self._raw)
+    return state
+  
   def binary(self, magic):
-    payload = format.CompoundType.binary(self)
-    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
-    command = self.command.encode('latin-1')
-    command = command + (b'\x00' * (12 - len(command)))  # pad to 12 bytes
-    return magic + command + struct.pack('<I',len(payload)) + checksum + payload
+    # messages are immutable, so broadcasting one message to many peers
+    # serializes and checksums once and shares the same bytes object
+    encodings = self._encodings
+    if encodings is None:
+      encodings = self._encodings = dict()
+    else:
+      data = encodings.get(magic)
+      if data is not None: return data
+    
+    payload = self._encoded()  # relaying a parsed message reuses its wire bytes
+    checksum = self._checksum
+    if checksum is None:
+      checksum = _checksum(payload)
+    command = self._command_key or _command_key(self.command)
+    data = b''.join((magic,command,struct.pack('<I',len(payload)),checksum,payload))
+    encodings[magic] = data
+    return data
   
   MessageTypes = dict()
+  CommandTypes = dict()  # map 12 bytes command field to message type
   
   @staticmethod
   def register(msg_type):
+    msg_type._command_key = _command_key(msg_type.command)
     Message.MessageTypes[msg_type.command] = msg_type
+    Message.CommandTypes[msg_type._command_key] = msg_type
   
   @staticmethod
-  def first_msg_len(data):
-    if len(data) < 20:  # not enough to determine payload size yet
+  def first_msg_len(data, start=0, end=None):  # message in data[start:end]
+    if end is None: end = len(data)
+    if end - start < 20:  # not enough to determine payload size yet
       return None
-    return struct.unpack('<I', data[16:20])[0] + 24
+    return struct.unpack_from('<I', data, start + 16)[0] + 24
   
   @classmethod
   def parse(cls, data, magic):
+    data = memoryview(data)
     if data[0:4] != magic:  # check magic
       raise MsgFormatError('bad magic number')
     
-    # get binary payload
-    (length, ) = struct.unpack('<I', data[16:20])
+    # get the correct class for this message's command, before any hashing
+    command = data[4:16].tobytes()
+    msg_type = cls.CommandTypes.get(command)
+    if msg_type is None:
+      command = command.strip(b'\x00').decode('latin-1')
+      raise UnknownMsgError('command: %r (%r)' % (command, data[:24].tobytes()))
+    
+    # get binary payload, parsed objects keep slices of it (no copy)
+    (length, ) = struct.unpack_from('<I', data, 16)
     payload = data[24:24 + length]
     
     # check the checksum
-    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    checksum = _checksum(payload)
     if data[20:24] != checksum:
       raise MsgFormatError('bad checksum')
     
-    # get the correct class for this message's command
-    command = data[4:16].strip(b'\x00').decode('latin-1')
-    msg_type = cls.MessageTypes.get(command)
-    if msg_type is None:
-      raise UnknownMsgError('command: %r (%r)' % (command, data))
-    
     # parse the properties using the correct class's parse
     (vl, message) = super(Message,msg_type).parse(payload)
     message._magic = magic
+    if vl == len(payload):  # checksum covers exactly the retained bytes
+      message._checksum = checksum
     return message
   
   @property
@@ -215,7 +259,7 @@ class Block(Message):
 
   @staticmethod
   def from_block(block):
-    return Block(block.version, block.previous_hash,  ## block.previous_block_hash,
+    return Block.from_trusted(block.version, block.previous_hash,  ## block.previous_block_hash,
                  block.merkle_root, block.timestamp, block.bits,
                  block.nonce, block.transactions)
   